@@ -1,56 +1,138 @@
 #!/usr/bin/python
 import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import click
 from lib import logger
 from lib.SpreeApiWrapper import SpreeApi
 from lib.config_loaders import IniConfigLoader
+from lib.gmc_batch import ProductsCustomBatch
+from lib.sync_state import StatusSnapshotStore
 from shopping.content import common
+from shopping.content.rate_limit import AdaptiveRateLimiter
 
 MAX_PAGE_SIZE = 100
+MAX_DELETE_BATCH_SIZE = 1000
+DEFAULT_STATUS_DB = 'data/gmc_statuses.db'
 
 
 @click.command('download gmc product statuses')
 @click.option('-c', '--check_expiration', type=int, default=0)
-def run(check_expiration):
+@click.option('--changed_only', is_flag=True, help='only act on products whose status changed since the last run')
+@click.option('-w', '--workers', type=int, default=4, help='threads processing the statuses of a page')
+def run(check_expiration, changed_only, workers):
     default_file_path = 'config.ini'
     config = IniConfigLoader(default_file_path)
 
     config.set_section('gmc')
     merchant_id = config.get('merchant_id')
+    status_db = config.get('status_db') or DEFAULT_STATUS_DB
 
     config.set_section('spree')
     api_token = config.get('api_token')
     endpoint = config.get('endpoint')
     spree_api = SpreeApi(endpoint, api_token)
 
-    service, config, _ = common.init(merchant_id)
+    rate_limiter = AdaptiveRateLimiter()
+    service, config, _ = common.init(merchant_id, rate_limiter=rate_limiter)
 
     check_expiration = True if check_expiration > 0 else False
     request = service.productstatuses().list(
         merchantId=merchant_id, maxResults=MAX_PAGE_SIZE, destinations='Shopping')
 
+    snapshots = StatusSnapshotStore(status_db)
+    snapshots.begin_run()
+
+    def forget(product_id):
+        # deleted products drop out of the next snapshot, failed ones get another try next run
+        snapshots.forget([product_id])
+
+    # deletions of a page are flushed on their own thread while the next page is fetched
+    deleter = ProductsCustomBatch(service, merchant_id, method='delete', batch_size=MAX_DELETE_BATCH_SIZE,
+                                  on_success=forget, on_failure=forget)
+    flusher = ThreadPoolExecutor(max_workers=1)
+    flushing = None
+
+    # the next page is fetched on its own thread while a pool works through the current one
+    fetcher = ThreadPoolExecutor(max_workers=1)
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    fetching = fetcher.submit(request.execute)
+
     page_no = 1
+    changed = 0
     while request is not None:
-        logger.info("processing page %s", page_no)
-        result = request.execute()
+        logger.info("processing page %s, rate limiter %s", page_no, rate_limiter.stats())
+        result = fetching.result()
         statuses = result.get('resources')
         if not statuses:
             print('No product statuses were returned.')
             break
-        for stat in statuses:
-            process_item(service, merchant_id, stat, check_expiration)
 
-        request = service.productstatuses().list_next(request, result)
+        next_request = service.productstatuses().list_next(request, result)
+        if next_request is not None:
+            fetching = fetcher.submit(next_request.execute)
+
+        items = []
+        for stat in statuses:
+            change = snapshots.record(stat)
+            if change is not None:
+                changed += 1
+            elif changed_only and not check_expiration:
+                continue
+            items.append(stat)
+        snapshots.commit()
+
+        # every item of the page is handed to the pool once, and the page is done before the next one starts
+        futures = [pool.submit(process_item, service, merchant_id, stat, check_expiration, deleter) for stat in items]
+        for future in futures:
+            future.result()
+
+        if len(deleter.entries) > 0:
+            wait_flush(flushing)
+            flushing = flusher.submit(push_deletions, deleter, deleter.take(), forget)
+
+        request = next_request
         page_no += 1
 
+    pool.shutdown()
+    fetcher.shutdown()
+    wait_flush(flushing)
+    push_deletions(deleter, deleter.take(), forget)
+    flusher.shutdown()
+    logger.info("deleted %s disapproved products, %s failed", deleter.succeeded, deleter.failed)
+
+    removed = snapshots.removed()
+    snapshots.forget([change.product_id for change in removed])
+    snapshots.close()
+    logger.info("%s product statuses changed, %s products no longer in gmc", changed, len(removed))
+
+
+def push_deletions(deleter, product_ids, forget):
+    """Pushes a chunk of deletions, forgetting its products in the snapshot if the push itself fails."""
+    try:
+        deleter.push(product_ids)
+    except Exception as e:
+        logger.exception(e)
+        for product_id in product_ids:
+            forget(product_id)
+
+
+def wait_flush(future):
+    if future is None:
+        return
+    try:
+        future.result()
+    except Exception as e:
+        logger.exception(e)
+
 
 def remove_from_gmc(product_id, service, merchant_id):
     request = service.products().delete(merchantId=merchant_id, productId=product_id)
     request.execute()
 
 
-def process_item(service, merchant_id, stat, check_expiration=False):
+def process_item(service, merchant_id, stat, check_expiration=False, deleter=None):
     if ':' not in stat['productId']:
         return
 
@@ -85,7 +167,10 @@ def process_item(service, merchant_id, stat, check_expiration=False):
 
             if disapproved:
                 logger.error("%s %s", product_id, issue_description)
-                remove_from_gmc(stat['productId'], service=service, merchant_id=merchant_id)
+                if deleter is not None:
+                    deleter.add(stat['productId'])
+                else:
+                    remove_from_gmc(stat['productId'], service=service, merchant_id=merchant_id)
             if expiring:
                 logger.error("%s expiring %s", product_id, stat['googleExpirationDate'])
     except Exception as e:
@@ -1,66 +1,251 @@
+import threading
+
+import click
 from lib import logger
 from lib.SpreeApiWrapper import SpreeApi
 from lib.config_loaders import IniConfigLoader
 from lib.feed_file_iterator import FeedFileIterator
+from lib.gmc_batch import ProductsCustomBatch
+from lib.pipeline import Pipeline
+from lib.sync_state import FingerprintStore, SyncCheckpoint, fingerprint
 from shopping.content import common
+from shopping.content.rate_limit import AdaptiveRateLimiter
+
+DEFAULT_FINGERPRINT_DB = 'data/gmc_fingerprints.db'
+DEFAULT_CHECKPOINT = 'data/gmc_sync.checkpoint.json'
+# refuse to delete more than this share of the pushed catalog in one run
+MAX_VANISHED_RATIO = 0.1
+# complete runs in a row an offer must be missing from before it is deleted
+VANISHED_RUNS = 2
 
 
-def run():
+@click.command('push spree products to gmc')
+@click.option('-b', '--batch_size', type=int, default=1, help='products per custombatch request, 1 inserts one by one')
+@click.option('-f', '--full', is_flag=True, help='push every product, even if it did not change since the last push')
+@click.option('--fetch_workers', type=int, default=2, help='spree pages fetched ahead in parallel')
+@click.option('--build_workers', type=int, default=1)
+@click.option('--push_workers', type=int, default=2)
+@click.option('--queue_size', type=int, default=200, help='items buffered between two stages')
+@click.option('-r', '--resume', is_flag=True, help='continue an interrupted run after its last fully pushed page')
+@click.option('--refresh_days', type=float, default=20,
+              help='push unchanged products again after this many days, before gmc expires them')
+def run(batch_size, full, fetch_workers, build_workers, push_workers, queue_size, resume, refresh_days):
     default_file_path = 'config.ini'
     config = IniConfigLoader(default_file_path)
 
     config.set_section('gmc')
     merchant_id = config.get('merchant_id')
+    fingerprint_db = config.get('fingerprint_db') or DEFAULT_FINGERPRINT_DB
+    checkpoint_path = config.get('checkpoint') or DEFAULT_CHECKPOINT
 
     config.set_section('spree')
     api_token = config.get('api_token')
     endpoint = config.get('endpoint')
     spree_api = SpreeApi(endpoint, api_token)
 
-    service, config, _ = common.init(merchant_id)
+    rate_limiter = AdaptiveRateLimiter(max_concurrency=max(1, push_workers))
+    service, config, _ = common.init(merchant_id, rate_limiter=rate_limiter)
     print(config)
 
-    per_page = 50
-    page = 1
-    while True:
-        products = spree_api.list_products(page, per_page)
-        for product in products:
-            try:
-                google_merchant_id = product['google_merchant_id']
-                product_type = get_product_types(product['classifications'])
-                google_product = {
-                    'offerId': product['google_merchant_id'],
-                    'availability': 'in stock',
-                    'price': {
-                        'value': float(product['price']),
-                        'currency': 'USD'
-                    },
-                    'contentLanguage': 'en',
-                    'targetCountry': 'US',
-                    'channel': 'online',
-                    'title': product['name'].title(),
-                    'brand': product['main_brand'],
-                    'gtin': product['barcode'],
-                    'description': product['description'],
-                    'link': 'https://everymarket.com/products/' + product['slug'],
-                    'imageLink': product['google_main_image'],
-                    'condition': 'new',
-                    'productTypes': product_type
-                }
-                print(product['google_merchant_id'].split('_')[-1])
-                if google_product['gtin'] is None or len(google_product['gtin']) == 0:
-                    google_product['mpn'] = product['google_merchant_id'].split('_')[-1]
-                    print(google_product['mpn'])
-                # print(get_product_types(product['classifications']))
-                request = service.products().insert(merchantId=merchant_id, body=google_product)
-                result = request.execute()
-                logger.info("%s", result)
-            except Exception as e:
-                logger.exception(e)
-
-        if len(products) < per_page:
-            break
+    checkpoint = SyncCheckpoint(checkpoint_path)
+    if resume and checkpoint.load():
+        logger.info("resuming after page %s", checkpoint.last_page)
+    store = FingerprintStore(fingerprint_db, refresh_age=refresh_days * 24 * 3600)
+    store.begin_run(checkpoint.run_started)
+
+    sync = GmcSync(spree_api, service, config, merchant_id, store, checkpoint, batch_size=batch_size, full=full)
+    pipeline = Pipeline(queue_size=queue_size)
+    pipeline.add_stage('fetch', sync.fetch, workers=fetch_workers)
+    pipeline.add_stage('build', sync.build, workers=build_workers)
+    pipeline.add_stage('push', sync.push, workers=push_workers)
+    pipeline.run(sync.pages())
+    sync.flush()
+    store.commit()
+    checkpoint.save()
+
+    logger.info("pushed %s products, %s failed, skipped %s unchanged", sync.pushed, sync.failed, sync.skipped)
+    logger.info("content api rate limiter %s", rate_limiter.stats())
+    if sync.last_page is None or checkpoint.last_page < sync.last_page:
+        logger.error("run stopped before the last page, resume from page %s", checkpoint.last_page + 1)
+        store.close()
+        return
+
+    delete_vanished(service, merchant_id, store, max(batch_size, 100))
+    store.close()
+    checkpoint.clear()
+
+
+class GmcSync(object):
+    """Fetch, build and push stages of a spree to gmc sync.
+
+    The service is shared by the push workers, each executes over its own http.
+    Spree products reach the build stage as (page, product) pairs so the checkpoint
+    knows when a page is fully handled.
+    """
+
+    def __init__(self, spree_api, service, config, merchant_id, store, checkpoint, per_page=50, batch_size=1, full=False):
+        self.spree_api = spree_api
+        self.service = service
+        self.config = config
+        self.merchant_id = merchant_id
+        self.store = store
+        self.checkpoint = checkpoint
+        self.per_page = per_page
+        self.batch_size = batch_size
+        self.full = full
+        self.last_page = None
+        self.pages_known = threading.Event()
+        self.lock = threading.Lock()
+        self.batch = None
+        if batch_size > 1:
+            self.batch = ProductsCustomBatch(service, merchant_id, batch_size=batch_size, on_success=self.mark_pushed,
+                                             on_failure=self.mark_failed)
+        self.pushed = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def pages(self):
+        page = self.checkpoint.last_page + 1
+        yield page
+        # the first response tells how many pages there are
+        self.pages_known.wait()
         page += 1
+        while self.last_page is not None and page <= self.last_page:
+            yield page
+            page += 1
+
+    def fetch(self, page):
+        try:
+            data = self.spree_api.list_products_page(page, self.per_page)
+            with self.lock:
+                self.last_page = max(1, int(data.get('pages') or page))
+        finally:
+            self.pages_known.set()
+        products = data['products']
+        if self.checkpoint.start_page(page, [p.get('google_merchant_id') for p in products]):
+            self.save_checkpoint()
+        return [(page, product) for product in products]
+
+    def build(self, item):
+        page, product = item
+        offer_id = product.get('google_merchant_id')
+        try:
+            self.store.seen(offer_id)
+            google_product = build_google_product(product)
+        except Exception:
+            self.handled(offer_id)
+            raise
+
+        if not self.full and not self.store.changed(google_product['offerId'], fingerprint(google_product)):
+            with self.lock:
+                self.skipped += 1
+            self.handled(offer_id)
+            return None
+        return [google_product]
+
+    def push(self, google_product):
+        if self.batch is not None:
+            self.batch.add(google_product)
+            return None
+
+        try:
+            request = self.service.products().insert(merchantId=self.merchant_id, body=google_product)
+            result = request.execute()
+        except Exception:
+            self.mark_failed(google_product)
+            raise
+        self.mark_pushed(google_product)
+        logger.info("%s", result)
+        return None
+
+    def flush(self):
+        if self.batch is not None:
+            self.batch.flush()
+            self.pushed = self.batch.succeeded
+            self.failed = self.batch.failed
+
+    def mark_pushed(self, google_product):
+        self.store.mark_pushed(google_product['offerId'], fingerprint(google_product))
+        if self.batch is None:
+            with self.lock:
+                self.pushed += 1
+        self.handled(google_product['offerId'])
+
+    def mark_failed(self, google_product):
+        if self.batch is None:
+            with self.lock:
+                self.failed += 1
+        self.handled(google_product['offerId'])
+
+    def handled(self, offer_id):
+        if self.checkpoint.done(offer_id):
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        # fingerprints of everything before the checkpoint must be on disk before it is
+        self.store.commit()
+        self.checkpoint.save()
+
+
+def delete_vanished(service, merchant_id, store, batch_size):
+    """Removes offers from gmc that were pushed before but are no longer listed in spree."""
+    vanished = store.vanished()
+    if len(vanished) == 0:
+        return
+
+    # a spree listing that stopped early looks exactly like a mass removal
+    if len(vanished) > store.count() * MAX_VANISHED_RATIO:
+        logger.error("%s of %s products vanished from spree, not deleting them", len(vanished), store.count())
+        return
+
+    # a product deleted in spree mid-run shifts the later pages, so their first products go unseen
+    # once; only offers missing from consecutive complete runs are really gone
+    confirmed = store.record_missing(vanished, VANISHED_RUNS)
+    store.commit()
+    logger.info("%s products not listed in spree, %s of them for %s runs in a row", len(vanished), len(confirmed),
+                VANISHED_RUNS)
+    if len(confirmed) == 0:
+        return
+
+    def forget(product_id):
+        store.remove([product_id.split(':', 3)[-1]])
+
+    batch = ProductsCustomBatch(service, merchant_id, method='delete', batch_size=batch_size, on_success=forget)
+    for offer_id in confirmed:
+        batch.add(gmc_product_id(offer_id))
+    batch.flush()
+    store.commit()
+    logger.info("deleted %s vanished products, %s failed", batch.succeeded, batch.failed)
+
+
+def gmc_product_id(offer_id):
+    return 'online:en:US:%s' % offer_id
+
+
+def build_google_product(product):
+    product_type = get_product_types(product['classifications'])
+    google_product = {
+        'offerId': product['google_merchant_id'],
+        'availability': 'in stock',
+        'price': {
+            'value': float(product['price']),
+            'currency': 'USD'
+        },
+        'contentLanguage': 'en',
+        'targetCountry': 'US',
+        'channel': 'online',
+        'title': product['name'].title(),
+        'brand': product['main_brand'],
+        'gtin': product['barcode'],
+        'description': product['description'],
+        'link': 'https://everymarket.com/products/' + product['slug'],
+        'imageLink': product['google_main_image'],
+        'condition': 'new',
+        'productTypes': product_type
+    }
+    if google_product['gtin'] is None or len(google_product['gtin']) == 0:
+        google_product['mpn'] = product['google_merchant_id'].split('_')[-1]
+    return google_product
 
 
 def get_product_types(classifications):
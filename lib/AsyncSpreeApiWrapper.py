@@ -0,0 +1,239 @@
+import asyncio
+
+import aiohttp
+
+from lib.SpreeApiWrapper import SpreeApi
+
+
+class SpreeResponse(object):
+    """Body of a finished call, readable after the aiohttp response is released."""
+
+    def __init__(self, status_code, text, data):
+        self.status_code = status_code
+        self.text = text
+        self.data = data
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self.data
+
+
+class AsyncSpreeApi(object):
+    """asyncio counterpart of SpreeApi.
+
+    Methods have the same names and arguments. Calls that return a requests.Response in
+    SpreeApi return a SpreeResponse here, the others return the decoded json. At most
+    max_in_flight requests are running at any time.
+
+        async with AsyncSpreeApi(endpoint, api_key) as spree_api:
+            products = await spree_api.list_products(1)
+    """
+
+    append_api_key = SpreeApi.append_api_key
+    loop_taxons = SpreeApi.loop_taxons
+
+    def __init__(self, endpoint, api_key, max_in_flight=100, timeout=None, session=None):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.session = session
+        # only a session built here is closed by close(), a passed in one belongs to the caller
+        self.owns_session = session is None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self.owns_session and self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    def get_session(self):
+        # the session and semaphore bind to the running loop, so they are created on first use
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def request(self, method, url, **kwargs):
+        session = self.get_session()
+        async with self.semaphore:
+            async with session.request(method, url, **kwargs) as response:
+                text = await response.text()
+                try:
+                    data = await response.json(content_type=None)
+                except ValueError:
+                    data = None
+                return SpreeResponse(response.status, text, data)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('DELETE', url, **kwargs)
+
+    async def list_orders(self, since_id=0, _id=None, since_time=None, state='complete'):
+        if _id is not None:
+            endpoint_url = self.append_api_key(self.endpoint + '/api/v1/orders?q[id_eq]=%s&q[state_eq]=%s' % (_id, state))
+        elif since_time is not None:
+            endpoint_url = self.append_api_key(
+                self.endpoint + '/api/v1/orders?q[completed_at_gt]=%s&q[state_eq]=%s&q[s]=completed_at:asc' % (since_time, state))
+        else:
+            endpoint_url = self.append_api_key(self.endpoint + '/api/v1/orders?q[id_gt]=%s&q[state_eq]=%s' % (since_id, state))
+        response = await self.get(endpoint_url)
+        return response.json()
+
+    async def get_order(self, order_id):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/orders/%s' % order_id)
+
+        return (await self.get(endpoint_url)).json()
+
+    async def create_product(self, product_data):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products')
+
+        return await self.post(endpoint_url, json=product_data)
+
+    async def get_product(self, product_id):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s' % product_id)
+
+        return (await self.get(endpoint_url)).json()
+
+    async def delete_product(self, product_id):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s' % product_id)
+
+        return await self.delete(endpoint_url)
+
+    async def update_product(self, product_id, product_data):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s' % product_id)
+
+        return await self.put(endpoint_url, json=product_data)
+
+    async def list_products(self, page, per_page=50):
+        try:
+            return (await self.list_products_page(page, per_page))['products']
+        except:
+            return []
+
+    async def list_products_page(self, page, per_page=50):
+        url = self.endpoint + '/api/v1/products?per_page=%s&page=%s' % (per_page, page)
+        endpoint_url = self.append_api_key(url)
+        response = await self.get(endpoint_url)
+        if not response.ok:
+            raise Exception("products page %s failed - %s %s" % (page, response.status_code, response.text[:200]))
+        return response.json()
+
+    async def iter_all_products(self, per_page=50, concurrency=4, ordered=True):
+        """Async generator over every product, see SpreeApi.iter_all_products."""
+        first_page = await self.list_products_page(1, per_page)
+        for product in first_page['products']:
+            yield product
+        pages = int(first_page.get('pages') or 1)
+
+        for start in range(2, pages + 1, concurrency):
+            tasks = [asyncio.ensure_future(self.list_products_page(page, per_page))
+                     for page in range(start, min(start + concurrency, pages + 1))]
+            try:
+                results = tasks if ordered else asyncio.as_completed(tasks)
+                for result in results:
+                    for product in (await result)['products']:
+                        yield product
+            finally:
+                # the consumer stopped early or a page failed, don't leave the other requests running
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def create_properties(self, product_id, name, value):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s/product_properties/%s' % (product_id, name))
+        product_data = {'product_property': {'value': value}}
+        return await self.put(endpoint_url, json=product_data)
+
+    async def update_property(self, product_id, name, value):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s/product_properties/%s' % (product_id, name))
+        product_data = {'product_property': {'value': value}}
+        return await self.put(endpoint_url, json=product_data)
+
+    async def create_property(self, product_id, name, value):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s/product_properties' % product_id)
+        product_data = {'product_property': {'value': value, 'property_name': name}}
+        return await self.post(endpoint_url, json=product_data)
+
+    async def create_variant(self, product_id, sku, option_value_ids, price, cost):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s/variants' % product_id)
+        data = {'variant': {'sku': sku, 'price': price, 'cost_price': cost, 'option_value_ids': [option_value_ids]}}
+        return await self.post(endpoint_url, json=data)
+
+    async def update_variant(self, product_id, variant_id, **params):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s/variants/%s' % (product_id, variant_id))
+        data = {'variant': params}
+        return await self.put(endpoint_url, json=data)
+
+    async def get_variant(self, product_id, sku, currency='USD'):
+        endpoint_url = self.append_api_key(
+            self.endpoint + '/api/v1/products/%s/variants?q[sku_eq]=%s&currency=%s' % (product_id, sku, currency))
+        return await self.get(endpoint_url)
+
+    async def create_stock(self, variant_id, qty, stock_location=1, backorderable=False):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/stock_locations/%s/stock_items' % stock_location)
+        data = {'stock_item': {'count_on_hand': qty, 'variant_id': variant_id, 'backorderable': backorderable}}
+        return await self.post(endpoint_url, json=data)
+
+    async def update_stock(self, stock_item_id, qty, stock_location=1, force=True, backorderable=False):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/stock_locations/%s/stock_items/%s' % (stock_location, stock_item_id))
+        data = {'stock_item': {'count_on_hand': qty, 'force': force, 'backorderable': backorderable}}
+        return await self.put(endpoint_url, json=data)
+
+    async def create_taxon(self, taxonomy_id, name, parent_id=None):
+        endpoint_url = self.append_api_key(self.endpoint + '/api/v1/taxonomies/%s/taxons' % taxonomy_id)
+        data = {'taxon': {'name': name, 'parent_id': parent_id}}
+        return await self.post(endpoint_url, json=data)
+
+    async def list_taxons(self, taxonomy_id, per_page=100):
+        taxons = []
+        page = 1
+
+        while True:
+            url = self.endpoint + '/api/v1/taxonomies/%s/taxons?per_page=%s&page=%s' % (taxonomy_id, per_page, page)
+            endpoint_url = self.append_api_key(url)
+            json_data = (await self.get(endpoint_url)).json()
+            taxons.extend(json_data['taxons'])
+            if len(json_data['taxons']) < per_page:
+                break
+            page += 1
+
+        taxons = self.loop_taxons(taxons, dict())
+
+        return taxons
+
+    async def find_taxon_by_name(self, name, parent_id, taxonomy_id=1, per_page=300):
+        try:
+            endpoint = '%s/api/v1/taxonomies/%s/taxons?q[name_cont]=%s&without_children=1&per_page=%s' % (
+                self.endpoint, taxonomy_id, name, per_page)
+            endpoint = self.append_api_key(endpoint)
+            response = (await self.get(endpoint, timeout=aiohttp.ClientTimeout(total=180))).json()
+            for taxon in response['taxons']:
+                if taxon['parent_id'] == parent_id and taxon['name'] == name:
+                    return taxon
+
+            for taxon in response['taxons']:
+                if taxon['name'] == name:
+                    return taxon
+        except:
+            pass
+        return None
@@ -1,13 +1,59 @@
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
 
 
 class SpreeApi(object):
     existed_taxons = dict()
 
-    def __init__(self, endpoint, api_key):
+    def __init__(self, endpoint, api_key, session=None, pool_size=20, timeout=None, keep_alive=True, gzip=True):
+        """
+        :param session: requests.Session compatible transport, a pooled one is built when omitted
+        :param pool_size: connections kept open to the spree host, should be at least the number of threads using the api
+        :param timeout: default timeout of every call, seconds or a (connect, read) tuple
+        :param keep_alive, gzip: applied per request when a session is passed in, its own headers stay untouched
+        """
         self.endpoint = endpoint
         self.api_key = api_key
+        self.timeout = timeout
+        headers = dict()
+        if gzip:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        if not keep_alive:
+            headers['Connection'] = 'close'
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(headers)
+            headers = dict()
+        self.session = session
+        self.headers = headers
+
+    def request(self, method, url, **kwargs):
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+        if self.headers:
+            headers = dict(self.headers)
+            headers.update(kwargs.get('headers') or {})
+            kwargs['headers'] = headers
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
 
     def list_orders(self, since_id=0, _id=None, since_time=None, state='complete'):
         if _id is not None:
@@ -17,108 +63,214 @@ class SpreeApi(object):
                 self.endpoint + '/api/v1/orders?q[completed_at_gt]=%s&q[state_eq]=%s&q[s]=completed_at:asc' % (since_time, state))
         else:
             endpoint_url = self.append_api_key(self.endpoint + '/api/v1/orders?q[id_gt]=%s&q[state_eq]=%s' % (since_id, state))
-        response = requests.get(endpoint_url)
+        response = self.get(endpoint_url)
         return response.json()
 
     def get_order(self, order_id):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/orders/%s' % order_id)
 
-        return requests.get(endpoint_url).json()
+        return self.get(endpoint_url).json()
 
     def create_product(self, product_data):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products')
 
-        return requests.post(endpoint_url, json=product_data)
+        return self.post(endpoint_url, json=product_data)
 
     def get_product(self, product_id):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s' % product_id)
 
-        return requests.get(endpoint_url).json()
+        return self.get(endpoint_url).json()
 
     def delete_product(self, product_id):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s' % product_id)
 
-        return requests.delete(endpoint_url)
+        return self.delete(endpoint_url)
 
     def update_product(self, product_id, product_data):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s' % product_id)
 
-        return requests.put(endpoint_url, json=product_data)
+        return self.put(endpoint_url, json=product_data)
 
     def list_products(self, page, per_page=50):
-        url = self.endpoint + '/api/v1/products?per_page=%s&page=%s' % (per_page, page)
-        endpoint_url = self.append_api_key(url)
         try:
-            return requests.get(endpoint_url).json()['products']
+            return self.list_products_page(page, per_page)['products']
         except:
             return []
 
+    def list_products_page(self, page, per_page=50):
+        """Raw products index response, including the count/pages pagination metadata."""
+        url = self.endpoint + '/api/v1/products?per_page=%s&page=%s' % (per_page, page)
+        endpoint_url = self.append_api_key(url)
+        response = self.get(endpoint_url)
+        response.raise_for_status()
+        return response.json()
+
+    def iter_all_products(self, per_page=50, concurrency=4, ordered=True):
+        """Yields every product, fetching pages concurrently once the page count is known.
+
+        The first page is read on its own for its `pages` metadata. With ordered=False
+        products are yielded page by page as soon as each page arrives.
+        """
+        first_page = self.list_products_page(1, per_page)
+        for product in first_page['products']:
+            yield product
+        pages = int(first_page.get('pages') or 1)
+        if pages <= 1:
+            return
+
+        def fetch(page):
+            # unlike list_products, a failed page raises instead of silently ending the listing
+            return self.list_products_page(page, per_page)['products']
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            if ordered:
+                # keep at most `concurrency` pages in flight ahead of the one being yielded
+                futures = dict()
+                next_page = 2
+                for page in range(2, pages + 1):
+                    while next_page <= pages and next_page < page + concurrency:
+                        futures[next_page] = executor.submit(fetch, next_page)
+                        next_page += 1
+                    for product in futures.pop(page).result():
+                        yield product
+            else:
+                # at most `concurrency` pages in flight, a new one is submitted as each completes
+                next_page = 2
+                futures = set()
+                while next_page <= pages and len(futures) < max(1, concurrency):
+                    futures.add(executor.submit(fetch, next_page))
+                    next_page += 1
+                while futures:
+                    future = next(as_completed(futures))
+                    futures.remove(future)
+                    if next_page <= pages:
+                        futures.add(executor.submit(fetch, next_page))
+                        next_page += 1
+                    for product in future.result():
+                        yield product
+
     def create_properties(self, product_id, name, value):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s/product_properties/%s' % (product_id, name))
         product_data = {'product_property': {'value': value}}
-        return requests.put(endpoint_url, json=product_data)
+        return self.put(endpoint_url, json=product_data)
 
     def update_property(self, product_id, name, value):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s/product_properties/%s' % (product_id, name))
         product_data = {'product_property': {'value': value}}
-        return requests.put(endpoint_url, json=product_data)
+        return self.put(endpoint_url, json=product_data)
 
     def create_property(self, product_id, name, value):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s/product_properties' % product_id)
         product_data = {'product_property': {'value': value, 'property_name': name}}
-        return requests.post(endpoint_url, json=product_data)
+        return self.post(endpoint_url, json=product_data)
 
     def create_variant(self, product_id, sku, option_value_ids, price, cost):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s/variants' % product_id)
         data = {'variant': {'sku': sku, 'price': price, 'cost_price': cost, 'option_value_ids': [option_value_ids]}}
-        return requests.post(endpoint_url, json=data)
+        return self.post(endpoint_url, json=data)
 
     def update_variant(self, product_id, variant_id, **params):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/products/%s/variants/%s' % (product_id, variant_id))
         data = {'variant': params}
-        return requests.put(endpoint_url, json=data)
+        return self.put(endpoint_url, json=data)
 
     def get_variant(self, product_id, sku, currency='USD'):
         endpoint_url = self.append_api_key(
             self.endpoint + '/api/v1/products/%s/variants?q[sku_eq]=%s&currency=%s' % (product_id, sku, currency))
-        return requests.get(endpoint_url)
+        return self.get(endpoint_url)
 
     def create_stock(self, variant_id, qty, stock_location=1, backorderable=False):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/stock_locations/%s/stock_items' % stock_location)
         data = {'stock_item': {'count_on_hand': qty, 'variant_id': variant_id, 'backorderable': backorderable}}
-        return requests.post(endpoint_url, json=data)
+        return self.post(endpoint_url, json=data)
 
     def update_stock(self, stock_item_id, qty, stock_location=1, force=True, backorderable=False):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/stock_locations/%s/stock_items/%s' % (stock_location, stock_item_id))
         data = {'stock_item': {'count_on_hand': qty, 'force': force, 'backorderable': backorderable}}
-        return requests.put(endpoint_url, json=data)
+        return self.put(endpoint_url, json=data)
 
     def create_taxon(self, taxonomy_id, name, parent_id=None):
         endpoint_url = self.append_api_key(self.endpoint + '/api/v1/taxonomies/%s/taxons' % taxonomy_id)
         data = {'taxon': {'name': name, 'parent_id': parent_id}}
-        return requests.post(endpoint_url, json=data)
+        return self.post(endpoint_url, json=data)
 
-    def list_taxons(self, taxonomy_id, per_page=1):
-        taxons = []
-        page = 1
+    def list_taxons(self, taxonomy_id, per_page=500, concurrency=4):
+        taxons = self.list_taxons_raw(taxonomy_id, per_page, concurrency)
+        taxons = self.loop_taxons(taxons, dict())
 
+        return taxons
+
+    def list_taxons_page(self, taxonomy_id, page, per_page=500, max_retries=3, slot_time=1.0):
+        """Raw taxons index response, retried max_retries times with exponential backoff."""
+        url = self.endpoint + '/api/v1/taxonomies/%s/taxons?per_page=%s&page=%s' % (taxonomy_id, per_page, page)
+        endpoint_url = self.append_api_key(url)
+        attempt = 0
         while True:
             try:
-                url = self.endpoint + '/api/v1/taxonomies/%s/taxons?per_page=%s&page=%s' % (taxonomy_id, per_page, page)
-                endpoint_url = self.append_api_key(url)
-                response = requests.get(endpoint_url)
-                json_data = response.json()
-                taxons.extend(json_data['taxons'])
-                if len(json_data['taxons']) < per_page:
-                    break
-                page += 1
-            except:
-                continue
-
-        taxons = self.loop_taxons(taxons, dict())
-
+                response = self.get(endpoint_url)
+                response.raise_for_status()
+                return response.json()
+            except (requests.RequestException, ValueError):
+                if attempt >= max_retries:
+                    raise
+                time.sleep(slot_time * 2 ** attempt)
+                attempt += 1
+
+    def list_taxons_raw(self, taxonomy_id, per_page=500, concurrency=4):
+        """Top level taxons of the taxonomy with their nested children, all pages in order.
+
+        Pages after the first are fetched concurrently when spree reports the page count.
+        """
+        first_page = self.list_taxons_page(taxonomy_id, 1, per_page)
+        taxons = list(first_page['taxons'])
+        pages = first_page.get('pages')
+        if pages is not None:
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+                results = executor.map(lambda page: self.list_taxons_page(taxonomy_id, page, per_page)['taxons'],
+                                       range(2, int(pages) + 1))
+                for page_taxons in results:
+                    taxons.extend(page_taxons)
+            return taxons
+
+        # no pagination metadata, read on until a short page
+        page_taxons = first_page['taxons']
+        page = 1
+        while len(page_taxons) >= per_page:
+            page += 1
+            page_taxons = self.list_taxons_page(taxonomy_id, page, per_page)['taxons']
+            taxons.extend(page_taxons)
         return taxons
 
+    def taxon_index(self, taxonomy_id, per_page=500, concurrency=4):
+        """Flattened taxon tree of a taxonomy.
+
+        Returns a dict with 'ids' (path -> id), 'parents' (id -> parent id) and 'paths'
+        (id -> path), paths are the taxon names below the taxonomy root joined by '>'.
+        """
+        index = {'ids': dict(), 'parents': dict(), 'paths': dict()}
+        stack = [(taxon, None) for taxon in reversed(self.list_taxons_raw(taxonomy_id, per_page, concurrency))]
+        while stack:
+            taxon, parent_path = stack.pop()
+            if taxon.get('parent_id') is None:
+                # the taxonomy root itself is not part of the paths
+                path = None
+            else:
+                path = taxon['name'] if parent_path is None else parent_path + '>' + taxon['name']
+                index['ids'][path] = taxon['id']
+                index['paths'][taxon['id']] = path
+                index['parents'][taxon['id']] = taxon['parent_id']
+            stack.extend((child, path) for child in reversed(taxon.get('taxons') or []))
+        return index
+
+    def taxons_etag(self, taxonomy_id, per_page=500):
+        """ETag of the first taxons page, None when spree doesn't send one."""
+        url = self.endpoint + '/api/v1/taxonomies/%s/taxons?per_page=%s&page=1' % (taxonomy_id, per_page)
+        try:
+            response = self.request('HEAD', self.append_api_key(url))
+            return response.headers.get('ETag')
+        except requests.RequestException:
+            return None
+
     def loop_taxons(self, taxons_response, taxons, parent_name=None):
         for taxon in taxons_response:
             key = taxon['name']
@@ -135,7 +287,7 @@ class SpreeApi(object):
             endpoint = '%s/api/v1/taxonomies/%s/taxons?q[name_cont]=%s&without_children=1&per_page=%s' % (
             self.endpoint, taxonomy_id, name, per_page)
             endpoint = self.append_api_key(endpoint)
-            response = requests.get(endpoint, timeout=180).json()
+            response = self.get(endpoint, timeout=180).json()
             for taxon in response['taxons']:
                 if taxon['parent_id'] == parent_id and taxon['name'] == name:
                     return taxon
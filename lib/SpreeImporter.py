@@ -1,20 +1,26 @@
+from contextlib import nullcontext
+
 from lib import logger
 from lib.SpreeApiWrapper import SpreeApi
+from lib.import_runner import StageTimer
 from lib.product_converters import EsBookConverter, EsProductConverter, AmazonProductPriceConverter, EsDvdConverter, EsCdConverter, \
     get_converter
 from lib.product_lib import save_spree_product
+from lib.taxon_cache import CategoryRules, TaxonTrie
 
 
 class SpreeProductImporter(object):
     existed_tags = []
-    existed_categories = dict()
     existed_authors = []
     shipping_category_id = 1
     prototype_id = 1
     tax_category_id = 1
+    # an ImportStats collecting the latency of every stage, set by ImportRunner
+    stats = None
 
     def __init__(self, spree_api: SpreeApi, import_taxons=True, download_images=True, shipping_category_id=1, prototype_id=1,
-                 tax_category_id=1, root_category_id=1, root_category='Categories', first_level_category=None, taxonomy_id=1):
+                 tax_category_id=1, root_category_id=1, root_category='Categories', first_level_category=None, taxonomy_id=1,
+                 taxon_cache=None):
         self.spree_api = spree_api
         self.shipping_category_id = shipping_category_id
         self.prototype_id = prototype_id
@@ -25,9 +31,10 @@ class SpreeProductImporter(object):
         self.first_level_category = first_level_category
         self.import_taxons = import_taxons
         self.download_images = download_images
-
-        if self.import_taxons:
-            self.existed_categories[root_category] = root_category_id
+        # a loaded TaxonCache of the taxonomy, makes every unknown category a lookup instead of a search
+        self.taxon_cache = taxon_cache
+        self.category_rules = CategoryRules(root_category, first_level_category=first_level_category)
+        self.taxon_trie = TaxonTrie(spree_api, taxonomy_id, root_category_id, taxon_cache)
 
     def process(self, product_info, source_price=0, used_price=None, roi=None, ad_cost=None):
         final_source_price = used_price if used_price is not None and used_price > 0 else source_price
@@ -41,22 +48,24 @@ class SpreeProductImporter(object):
 
         product_data['images'] = product_converter.get_images()
 
-        response = self.spree_api.create_product(product_data)
-        product = response.json()
+        with self.timed('create_product'):
+            response = self.spree_api.create_product(product_data)
+            product = response.json()
 
-        if 'errors' in product:
-            logger.error("%s - %s ", product_converter.get_asin(), product['errors'])
-            raise Exception("%s - %s " % (product_converter.get_asin(), product['errors']))
+            if 'errors' in product:
+                logger.error("%s - %s ", product_converter.get_asin(), product['errors'])
+                raise Exception("%s - %s " % (product_converter.get_asin(), product['errors']))
 
-        if 'id' not in product:
-            logger.error("%s - failed, %s", product_converter.get_asin(), product)
-            raise Exception("%s - failed " % product_converter.get_asin())
+            if 'id' not in product:
+                logger.error("%s - failed, %s", product_converter.get_asin(), product)
+                raise Exception("%s - failed " % product_converter.get_asin())
 
         product_id = product['id']
 
         if self.import_taxons:
             try:
-                self.update_taxons(product_id, product_converter)
+                with self.timed('update_taxons'):
+                    self.update_taxons(product_id, product_converter)
             except Exception as e:
                 logger.exception(e)
 
@@ -67,24 +76,26 @@ class SpreeProductImporter(object):
         site_name = self.store.site_name
         product_id = product['id']
         slug = product['slug']
-        product = self.spree_api.get_product(slug)
         try:
-            sku = product['master']['sku']
-            response = self.spree_api.get_variant(product_id, sku)
-            variants = response.json()
-            if 'variants' in variants and len(variants['variants']) > 0:
-                variant = variants['variants'][0]
+            variant = self.master_variant(product)
+            if variant is None:
+                variant = self.fetch_master_variant(product_id, slug)
+            if variant is not None:
+                sku = variant['sku']
                 qty = 3 if source_price > 0 else 0
-                self.spree_api.update_stock(variant['stock_items'][0]['id'], qty)
+                with self.timed('update_stock') as stage:
+                    response = self.spree_api.update_stock(variant['stock_items'][0]['id'], qty)
+                    self.check_stock_update(stage, sku, response)
 
                 # image = variant['images'][0]['large_url']
                 # if 'active_storage' in image:
                 #     image = None
-                save_spree_product(site_name, sku, variant['price'], variant['id'],
-                                   variant['stock_items'][0]['id'],
-                                   product_converter,
-                                   product_type='product',
-                                   slug=slug)
+                with self.timed('save_spree_product'):
+                    save_spree_product(site_name, sku, variant['price'], variant['id'],
+                                       variant['stock_items'][0]['id'],
+                                       product_converter,
+                                       product_type='product',
+                                       slug=slug)
 
         except Exception as e:
             logger.exception(e)
@@ -93,6 +104,38 @@ class SpreeProductImporter(object):
     def get_product_converter(self, product_info, source_price):
         return get_converter(product_info)
 
+    @staticmethod
+    def master_variant(product):
+        """The master variant embedded in a product response, None when fields we need are missing."""
+        variant = product.get('master')
+        if not variant or any(variant.get(field) is None for field in ('id', 'sku', 'price')):
+            return None
+        stock_items = variant.get('stock_items')
+        if not stock_items or stock_items[0].get('id') is None:
+            return None
+        return variant
+
+    def fetch_master_variant(self, product_id, slug):
+        with self.timed('get_product'):
+            product = self.spree_api.get_product(slug)
+        sku = product['master']['sku']
+        with self.timed('get_variant'):
+            response = self.spree_api.get_variant(product_id, sku)
+            variants = response.json()
+        if 'variants' in variants and len(variants['variants']) > 0:
+            return variants['variants'][0]
+        return None
+
+    def timed(self, stage):
+        return self.stats.timed(stage) if self.stats is not None else nullcontext(StageTimer())
+
+    @staticmethod
+    def check_stock_update(stage, sku, response):
+        """A rejected stock update only fails its stage, the product itself was created fine."""
+        if not response.ok:
+            stage.failed = True
+            logger.error("%s - stock update failed, %s %s", sku, response.status_code, response.text)
+
     def update_taxons(self, product_id, categories):
         taxon_ids = set()
         if categories is not None:
@@ -103,7 +146,9 @@ class SpreeProductImporter(object):
         taxon_ids = list(taxon_ids)
         if len(taxon_ids) > 0:
             params = {'product': {'taxon_ids': taxon_ids}}
-            self.spree_api.update_product(product_id, params)
+            response = self.spree_api.update_product(product_id, params)
+            if not response.ok:
+                raise Exception("%s - taxons update failed, %s %s" % (product_id, response.status_code, response.text))
 
     def prepare_properties(self, product_converter):
         properties = {
@@ -162,64 +207,33 @@ class SpreeProductImporter(object):
         taxon = self.spree_api.find_taxon_by_name(name, parent_id,taxonomy_id)
         return taxon['id'] if taxon is not None else None
 
+    def get_category_rules(self, ignore=None, replacements=None):
+        if ignore is None and replacements is None:
+            return self.category_rules
+        return CategoryRules(self.root_category, ignore, replacements, self.first_level_category)
+
     def prepare_category_ids(self, taxonomy_id, categories, ignore=None, replacements=None):
-        if replacements is None:
-            replacements = {'CDs & Vinyl': 'Music'}
-        if ignore is None:
-            ignore = ['Books', 'Subjects']
-
-        if isinstance(categories, str):
-            categories = categories.split(";")
-
-        taxon_ids = [self.root_category_id]
-        for category in categories:
-            if isinstance(category, str):
-                taxons = category.split('>')
-            else:
-                taxons = category
-
-            key = self.root_category
-            self.existed_categories[key] = self.root_category_id
-            taxons = [t.strip() for t in taxons if t not in ignore]
-            taxon_index = 0
-            for taxon in taxons:
-                if self.first_level_category is not None and self.first_level_category not in taxons:
-                    continue
-
-                if taxon in ignore:
-                    continue
-
-                if taxon in replacements:
-                    taxon = replacements[taxon]
-                if taxon == key:
-                    continue
-
-                if self.first_level_category is not None and taxon == self.first_level_category:
-                    continue
-
-                parent_key = key
-                key = key + '>' + taxon if len(key) > 0 else taxon
-                if key not in self.existed_categories:
-                    parent_id = self.existed_categories[parent_key] if parent_key in self.existed_categories else None
-                    taxon_id = self.existed_categories[key] if key in self.existed_categories else self.find_taxon_id(taxon, parent_id,
-                                                                                                                      self.taxonomy_id)
-
-                    if taxon_id is not None:
-                        self.existed_categories[key] = taxon_id
-                    else:
-                        try:
-                            res = self.spree_api.create_taxon(taxonomy_id, taxon, parent_id)
-                            response = res.json()
-                            self.existed_categories[key] = response['id']
-                            logger.info("%s-%s", taxon, parent_id)
-                        except:
-                            pass
-
-                if key in self.existed_categories:
-                    taxon_ids.append(self.existed_categories[key])
-
-                taxon_index += 1
-        return taxon_ids
+        return self.prepare_category_ids_batch(taxonomy_id, [categories], ignore, replacements)[0]
+
+    def prepare_category_ids_batch(self, taxonomy_id, categories_list, ignore=None, replacements=None):
+        """Taxon ids of the categories of many products, creating every missing taxon only once."""
+        rules = self.get_category_rules(ignore, replacements)
+        product_paths = []
+        for categories in categories_list:
+            if isinstance(categories, str):
+                categories = categories.split(";")
+            product_paths.append([rules.normalize(category) for category in categories])
+
+        resolved = self.taxon_trie.resolve_batch(path for paths in product_paths for path in paths)
+
+        result = []
+        for paths in product_paths:
+            taxon_ids = [self.root_category_id]
+            for path in paths:
+                if path is not None:
+                    taxon_ids.extend(resolved[path][1:])
+            result.append(taxon_ids)
+        return result
 
 
 class SpreeDvdImporter(SpreeProductImporter):
@@ -268,17 +282,23 @@ class SpreeBookImporter(SpreeProductImporter):
                 sku = product['master']['sku'] + '-' + condition
                 price_converter = AmazonProductPriceConverter(product['master']['sku'], prices[condition])
                 price = price_converter.get_price()
-                response = self.spree_api.create_variant(product_id, sku, id, price, prices[condition])
-                variant = response.json()
+                with self.timed('create_variant'):
+                    response = self.spree_api.create_variant(product_id, sku, id, price, prices[condition])
+                    variant = response.json()
+                    if not response.ok or 'errors' in variant:
+                        raise Exception("%s - variant failed, %s" % (sku, variant.get('errors', response.status_code)))
 
                 qty = 3 if price > 0 else 0
-                self.spree_api.update_stock(variant['stock_items'][0]['id'], qty)
-
-                save_spree_product(site_name, sku, variant['price'], variant['id'],
-                                   variant['stock_items'][0]['id'],
-                                   product_converter,
-                                   product_type='book',
-                                   slug=slug)
+                with self.timed('update_stock') as stage:
+                    response = self.spree_api.update_stock(variant['stock_items'][0]['id'], qty)
+                    self.check_stock_update(stage, sku, response)
+
+                with self.timed('save_spree_product'):
+                    save_spree_product(site_name, sku, variant['price'], variant['id'],
+                                       variant['stock_items'][0]['id'],
+                                       product_converter,
+                                       product_type='book',
+                                       slug=slug)
 
         except Exception as e:
             logger.exception(e)
@@ -0,0 +1,146 @@
+import json
+import random
+import threading
+import time
+
+from lib import logger
+from shopping.content import common
+
+# Content API rejects custombatch requests with more entries than this.
+MAX_BATCH_SIZE = 1000
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+
+
+class ProductsCustomBatch(object):
+    """Collects products().custombatch entries and flushes them in chunks.
+
+    Entries that fail with a retryable error are re-sent on their own; the rest
+    of the batch is never pushed twice. add and flush may be called from several
+    threads sharing a service from common.init.
+    """
+
+    def __init__(self, service, merchant_id, method='insert', batch_size=250, max_retries=3, slot_time=2.0, on_success=None,
+                 on_failure=None):
+        self.service = service
+        self.merchant_id = merchant_id
+        self.method = method
+        self.batch_size = max(1, min(int(batch_size), MAX_BATCH_SIZE))
+        self.max_retries = max_retries
+        self.slot_time = slot_time
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.lock = threading.Lock()
+        self.entries = []
+        self.succeeded = 0
+        self.failed = 0
+
+    def add(self, payload):
+        """Queues a product (insert) or a product id (delete), flushing when the batch is full."""
+        with self.lock:
+            self.entries.append(payload)
+            if len(self.entries) < self.batch_size:
+                return []
+            pending, self.entries = self.entries, []
+        return self.push(pending)
+
+    def flush(self):
+        """Pushes every queued entry and returns the payloads that finally failed."""
+        return self.push(self.take())
+
+    def take(self):
+        """Removes and returns the queued entries, for pushing them elsewhere."""
+        with self.lock:
+            pending, self.entries = self.entries, []
+        return pending
+
+    def push(self, pending):
+        failed = []
+        retry_num = 0
+        while pending:
+            try:
+                done, retry, errors = self.execute(pending)
+            except Exception as e:
+                # retry_request gave up or the transport failed, nothing of the chunk is known to be pushed
+                logger.exception(e)
+                logger.error("%s of %s entries failed", self.method, len(pending))
+                failed.extend(pending)
+                break
+            for payload, error in errors:
+                failed.append(payload)
+                logger.error("%s %s failed: %s", self.method, self.describe(payload), json.dumps(error, sort_keys=True))
+            with self.lock:
+                self.succeeded += len(done)
+            if self.on_success is not None:
+                for payload in done:
+                    self.on_success(payload)
+
+            if not retry:
+                break
+            if retry_num >= self.max_retries:
+                for payload in retry:
+                    failed.append(payload)
+                    logger.error("%s %s failed after %s retries", self.method, self.describe(payload), retry_num)
+                break
+
+            retry_num += 1
+            sleep_time = random.randint(1, 2 ** retry_num) * self.slot_time
+            logger.info("retrying %s failed %s entries after %.2f seconds", len(retry), self.method, sleep_time)
+            time.sleep(sleep_time)
+            pending = retry
+
+        with self.lock:
+            self.failed += len(failed)
+        if self.on_failure is not None:
+            for payload in failed:
+                self.on_failure(payload)
+        return failed
+
+    def execute(self, payloads):
+        """Sends one custombatch request.
+
+        Returns:
+          A (done, retry, errors) tuple: payloads that went through, payloads worth sending again and
+          (payload, error) pairs that are permanent.
+        """
+        batch = {'entries': [self.build_entry(i, payload) for i, payload in enumerate(payloads)]}
+        request = self.service.products().custombatch(body=batch)
+        result = common.retry_request(request, slot_time=self.slot_time)
+
+        done = []
+        retry = []
+        errors = []
+        if result.get('kind') != 'content#productsCustomBatchResponse':
+            logger.error("custombatch error. Response: %s", result)
+            return done, list(payloads), errors
+
+        answered = set()
+        for entry in result.get('entries', []):
+            answered.add(entry['batchId'])
+            payload = payloads[entry['batchId']]
+            error = entry.get('errors')
+            if not error:
+                done.append(payload)
+            elif error.get('code') in RETRYABLE_CODES:
+                retry.append(payload)
+            else:
+                errors.append((payload, error))
+        # entries the response says nothing about are sent again
+        retry.extend(payload for i, payload in enumerate(payloads) if i not in answered)
+        return done, retry, errors
+
+    def build_entry(self, batch_id, payload):
+        entry = {
+            'batchId': batch_id,
+            'merchantId': self.merchant_id,
+            'method': self.method,
+        }
+        if self.method == 'insert':
+            entry['product'] = payload
+        else:
+            entry['productId'] = payload
+        return entry
+
+    def describe(self, payload):
+        if isinstance(payload, dict):
+            return payload.get('offerId')
+        return payload
@@ -0,0 +1,85 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from lib import logger
+from lib.pipeline import Pipeline
+
+
+class StageStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.failed = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+class StageTimer(object):
+    """Yielded by ImportStats.timed, set failed for a stage that went wrong without raising."""
+
+    def __init__(self):
+        self.failed = False
+
+
+class ImportStats(object):
+    """Thread-safe call count, failures and latency of every importer stage."""
+
+    def __init__(self):
+        self.stages = dict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, stage):
+        started = time.monotonic()
+        timer = StageTimer()
+        failed = True
+        try:
+            yield timer
+            failed = timer.failed
+        finally:
+            self.record(stage, time.monotonic() - started, failed)
+
+    def record(self, stage, seconds, failed=False):
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.calls += 1
+            stats.total_time += seconds
+            stats.max_time = max(stats.max_time, seconds)
+            if failed:
+                stats.failed += 1
+
+    def log(self):
+        with self.lock:
+            for name, stats in self.stages.items():
+                logger.info("%s: %s calls, %s failed, avg %.3fs, max %.3fs", name, stats.calls, stats.failed,
+                            stats.total_time / stats.calls, stats.max_time)
+
+
+class ImportRunner(object):
+    """Runs importer.process over many products on a pool of threads.
+
+    The calls of one product happen in order on one thread, products run in parallel.
+    process_args maps a product_info to the keyword arguments of its process call
+    (prices, roi...).
+    """
+
+    def __init__(self, importer, workers=8, queue_size=100, process_args=None):
+        self.importer = importer
+        self.workers = workers
+        self.queue_size = queue_size
+        self.process_args = process_args
+        self.stats = ImportStats()
+        importer.stats = self.stats
+
+    def run(self, products):
+        pipeline = Pipeline(self.queue_size).add_stage('import', self.process, self.workers)
+        pipeline.run(products)
+        self.stats.log()
+        return self.stats
+
+    def process(self, product_info):
+        kwargs = self.process_args(product_info) if self.process_args is not None else {}
+        with self.stats.timed('process'):
+            self.importer.process(product_info, **kwargs)
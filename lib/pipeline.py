@@ -0,0 +1,87 @@
+import threading
+from queue import Queue
+
+from lib import logger
+
+_DONE = object()
+
+
+class Stage(object):
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.processed = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.finished_workers = 0
+
+
+class Pipeline(object):
+    """Producer/consumer pipeline of thread pools joined by bounded queues.
+
+    Every stage function takes one item and returns an iterable of items for the next
+    stage (or None). A full queue blocks the stage feeding it, so a slow stage holds back
+    the ones before it instead of piling items up in memory.
+    """
+
+    def __init__(self, queue_size=10):
+        self.queue_size = queue_size
+        self.stages = []
+
+    def add_stage(self, name, func, workers=1):
+        self.stages.append(Stage(name, func, workers))
+        return self
+
+    def run(self, source):
+        """Feeds every item of source through the stages and blocks until all of them are done."""
+        queues = [Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+        for index, stage in enumerate(self.stages):
+            out_queue = queues[index + 1] if index + 1 < len(queues) else None
+            next_workers = self.stages[index + 1].workers if out_queue is not None else 0
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._work, name='%s-%s' % (stage.name, i),
+                                          args=(stage, queues[index], out_queue, next_workers))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        first = queues[0]
+        try:
+            for item in source:
+                first.put(item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                first.put(_DONE)
+
+        for thread in threads:
+            thread.join()
+
+        for stage in self.stages:
+            logger.info("stage %s processed %s items, %s failed", stage.name, stage.processed, stage.failed)
+
+    def _work(self, stage, in_queue, out_queue, next_workers):
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                break
+            try:
+                results = stage.func(item)
+                if results is not None and out_queue is not None:
+                    for result in results:
+                        out_queue.put(result)
+                with stage.lock:
+                    stage.processed += 1
+            except Exception as e:
+                with stage.lock:
+                    stage.failed += 1
+                logger.exception(e)
+
+        with stage.lock:
+            stage.finished_workers += 1
+            last = stage.finished_workers == stage.workers
+        # the last worker out tells every worker of the next stage to stop
+        if last and out_queue is not None:
+            for _ in range(next_workers):
+                out_queue.put(_DONE)
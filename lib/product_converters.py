@@ -1,5 +1,10 @@
+import functools
 import html
 import random
+from collections import namedtuple
+from collections.abc import MutableMapping
+
+import numpy as np
 import shopify
 import yaml
 from bs4 import BeautifulSoup
@@ -8,30 +13,106 @@ from lib import logger
 
 description_blacklist_keywords = ['Amazon', 'donates', 'Licensed', 'certified']
 
+PriceBatch = namedtuple('PriceBatch', ['prices', 'compare_at_prices', 'zero_price'])
+
+# attribute index of products without attributes, shared and never written to
+NO_ATTRIBUTES = {}
+
+
+def get_converter(product_info, converter_class=None):
+    """Converter of a product record, converter_class skips the classification for homogeneous feeds."""
+    if converter_class is None:
+        converter_class = converter_registry.classify(product_info)
+    return converter_class(product_info)
+
+
+class ConverterRegistry(object):
+    """Picks the converter class of a product record from registered rules.
+
+    Rules are tried by descending priority, rules of the same priority in registration order.
+    The default class is used when no rule matches.
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+        self.rules = []
+
+    def register(self, converter_class, predicate=None, prefix=None, priority=0):
+        """Registers a rule matching records for which predicate(record) is true or whose asin starts with prefix."""
+        if predicate is None:
+            if prefix is None:
+                raise ValueError('a predicate or a prefix is required')
+            predicate = lambda record: record['asin'].startswith(prefix)
+        self.rules.append((-priority, len(self.rules), predicate, converter_class))
+        self.rules.sort(key=lambda rule: rule[:2])
+
+    def classify(self, product_info):
+        for _, _, predicate, converter_class in self.rules:
+            if predicate(product_info):
+                return converter_class
+        return self.default
+
+    def classify_batch(self, records, converter_class=None):
+        """Returns the records grouped by converter class, as a dict of class -> list of records."""
+        if converter_class is not None:
+            return {converter_class: list(records)}
 
-def get_converter(product_info):
-    if product_info['asin'].startswith('ES'):
-        return EuropaProductConverter(product_info)
+        groups = dict()
+        for record in records:
+            groups.setdefault(self.classify(record), []).append(record)
+        return groups
 
-    if product_info['asin'].startswith('AE'):
-        return AliExpressProductConverter(product_info)
+    def convert_batch(self, records, converter_class=None):
+        """Like classify_batch, with a converter built for every record."""
+        return dict((cls, [cls(record) for record in group])
+                    for cls, group in self.classify_batch(records, converter_class).items())
 
-    if 'binding' in product_info and product_info['binding'] == 'Audio CD':
-        return EsCdConverter(product_info)
 
-    if 'ProductGroup' in product_info and product_info['ProductGroup'] == 'Music':
-        return EsCdConverter(product_info)
+class TrackedProduct(MutableMapping):
+    """converter.product: the caller's product dict, not copied, invalidating the converter's
+    memoized values whenever it is changed through this view."""
+    __slots__ = ('data', 'owner')
 
-    if 'binding' in product_info and product_info['binding'] == 'DVD':
-        return EsCdConverter(product_info)
+    def __init__(self, data, owner):
+        self.data = data
+        self.owner = owner
 
-    if 'ProductGroup' in product_info and product_info['ProductGroup'] == 'DVD':
-        return EsDvdConverter(product_info)
+    def __getitem__(self, key):
+        return self.data[key]
 
-    if not product_info['asin'].startswith('B'):
-        return EsBookConverter(product_info)
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.owner.invalidate()
 
-    return EsProductConverter(product_info)
+    def __delitem__(self, key):
+        del self.data[key]
+        self.owner.invalidate()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+
+def memoized(method):
+    """Caches the result of a converter method until the product is replaced or changed."""
+    key = method.__qualname__
+
+    @functools.wraps(method)
+    def wrapper(self):
+        cache = self.derived_cache()
+        if key not in cache:
+            cache[key] = method(self)
+        return cache[key]
+
+    return wrapper
 
 
 def check_digit_10(isbn):
@@ -80,6 +161,9 @@ def clean_html(raw_html):
 
 
 class ShopifyConverter(object):
+    # converters are slotted, batch runs hold hundreds of thousands of them
+    __slots__ = ()
+
     def convert(self):
         raise NotImplementedError()
 
@@ -135,6 +219,14 @@ class EsProductConverter(ShopifyConverter):
         'Color': 'color',
         'Model': 'model',
     }
+    property_items = tuple(properties.items())
+
+    __slots__ = ('_product', '_view', '_derived', '_attributes', 'source_price', 'asin', 'roi', 'ad_cost')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # iterated for every record, so built once per class
+        cls.property_items = tuple(cls.properties.items())
 
     def __init__(self, product, source_price=None, roi=0.75, ad_cost=3.0):
         self.product = product
@@ -143,6 +235,33 @@ class EsProductConverter(ShopifyConverter):
         self.roi = roi
         self.ad_cost = ad_cost
 
+    @property
+    def product(self):
+        # the view is only built for code that reads or changes the product through it
+        if self._view is None:
+            self._view = TrackedProduct(self._product, self)
+        return self._view
+
+    @product.setter
+    def product(self, product):
+        if isinstance(product, TrackedProduct):
+            product = product.data
+        self._product = product
+        self._view = None
+        self._derived = None
+        self._attributes = None
+
+    def invalidate(self):
+        """Drops memoized values; changes made through self.product call it on their own."""
+        self._derived = None
+        self._attributes = None
+
+    def derived_cache(self):
+        """Memoized values of the current product, created on first use."""
+        if self._derived is None:
+            self._derived = dict()
+        return self._derived
+
     def can_upload(self):
         if self.get_image() is None:
             logger.error("%s has no image", self.get_asin())
@@ -219,6 +338,7 @@ class EsProductConverter(ShopifyConverter):
     def get_sku(self):
         return self.get_asin()
 
+    @memoized
     def get_title(self):
         title = self.get('title')
         if title is None or len(title) == 0:
@@ -230,12 +350,14 @@ class EsProductConverter(ShopifyConverter):
     def get_handle(self):
         return create_slug(self.get_title())
 
+    @memoized
     def get_brand(self):
         brand = self.get('brand')
         if brand is not None:
             brand = brand.replace('Visit the ', '')
         return brand
 
+    @memoized
     def get_image(self):
         try:
             return self.get_images()[0]
@@ -245,6 +367,7 @@ class EsProductConverter(ShopifyConverter):
     def get_binding(self):
         return self.get('binding')
 
+    @memoized
     def get_upc(self):
         if self.get('ProductGroup') == 'Book' or self.get('binding') == 'Book' or not self.get_asin().startswith('B'):
             return self.get_asin()
@@ -268,6 +391,7 @@ class EsProductConverter(ShopifyConverter):
 
         return None
 
+    @memoized
     def get_mpn(self):
         for attr in ['mpn', 'PartNumber', 'Model']:
             mpn = self.get(attr)
@@ -329,6 +453,7 @@ class EsProductConverter(ShopifyConverter):
 
         return taxons
 
+    @memoized
     def get_description(self):
         desc = self.get('features')
         if desc is None:
@@ -336,7 +461,7 @@ class EsProductConverter(ShopifyConverter):
 
         features_list = ['<li>%s</li>' % l for l in desc.split('\n')]
 
-        for k, v in self.properties.items():
+        for k, v in self.property_items:
             value = self.get(v)
             if value is not None and len(value) > 0:
                 features_list.append('<li>%s: %s</li>' % (k, value))
@@ -357,6 +482,7 @@ class EsProductConverter(ShopifyConverter):
 
         return desc
 
+    @memoized
     def get_original_description(self):
         description = self.get('description')
         if description is not None and len(description) > 0:
@@ -366,6 +492,7 @@ class EsProductConverter(ShopifyConverter):
 
         return description
 
+    @memoized
     def get_features(self):
         return self.get('features')
 
@@ -379,6 +506,7 @@ class EsProductConverter(ShopifyConverter):
 
         return None
 
+    @memoized
     def get_images(self):
         images = self.get('images')
         if images is not None and len(images) > 0:
@@ -447,29 +575,45 @@ class EsProductConverter(ShopifyConverter):
         return '%s %s' % (round(self.get_weight(), 1), self.get_weight_unit())
 
     def get(self, attr):
+        product = self._product
+        if attr in product:
+            return product[attr]
+
+        index = self._attributes
+        if index is None:
+            index = self._attributes = self.attribute_index()
+        if attr in index:
+            return index[attr]
+
         if 'get_' in attr:
             method_name = attr.lower()
             method_name_callable = getattr(self, method_name, None)
 
             if callable(method_name_callable):
                 return method_name_callable()
+        return None
 
-        if attr in self.product:
-            return self.product[attr]
+    def attribute_index(self):
+        """Unwrapped values of product['attributes'], get builds it on the first lookup that needs it."""
+        attributes = self._product.get('attributes')
+        if not isinstance(attributes, dict):
+            return NO_ATTRIBUTES
 
-        if 'attributes' in self.product and attr in self.product['attributes']:
+        index = dict()
+        for key, attr_value in attributes.items():
             try:
-                attr_value = self.product['attributes'][attr]
                 if isinstance(attr_value, dict):
-                    return attr_value['value']
-                if isinstance(attr_value, list):
-                    return [v['value'] for v in attr_value]
+                    index[key] = attr_value['value']
+                elif isinstance(attr_value, list):
+                    index[key] = [v['value'] for v in attr_value]
             except:
                 pass
-        return None
+        return index
 
 
 class EsDvdConverter(EsProductConverter):
+    __slots__ = ()
+
     def get_actors(self):
         return [a['value'] for a in self.product['attributes']['Actor']]
 
@@ -505,6 +649,7 @@ class EsDvdConverter(EsProductConverter):
         running_time = self.product['attributes']['RunningTime']
         return running_time['value'] + ' ' + running_time['Units']['value']
 
+    @memoized
     def get_original_description(self):
         description = self.get('description')
         if description is not None and len(description) > 0:
@@ -550,6 +695,8 @@ class EsDvdConverter(EsProductConverter):
 
 
 class EsBookConverter(EsProductConverter):
+    __slots__ = ()
+
     properties = {
         'ISBN': 'asin',
         'ISBN-13': 'ISBN_13',
@@ -562,9 +709,10 @@ class EsBookConverter(EsProductConverter):
         'Page Count': 'pageCount'
     }
 
+    @memoized
     def get_description(self):
         features_list = []
-        for k, v in self.properties.items():
+        for k, v in self.property_items:
             value = self.get(v)
             if value is not None:
                 value = str(value)
@@ -578,6 +726,7 @@ class EsBookConverter(EsProductConverter):
 
         return desc
 
+    @memoized
     def get_original_description(self):
         description = self.get('description')
 
@@ -591,6 +740,7 @@ class EsBookConverter(EsProductConverter):
 
         return description
 
+    @memoized
     def get_brand(self):
         publisher = self.get('Publisher')
         if publisher is not None:
@@ -598,6 +748,7 @@ class EsBookConverter(EsProductConverter):
 
         return self.get('publisher')
 
+    @memoized
     def get_upc(self):
         isbn13 = self.get('ISBN_13')
         if isbn13 is not None:
@@ -615,6 +766,7 @@ class EsBookConverter(EsProductConverter):
         except:
             return None
 
+    @memoized
     def get_author(self):
         authors = self.get('Author')
         if authors is None:
@@ -660,7 +812,7 @@ class EsBookConverter(EsProductConverter):
 
     def meta_fields(self):
         metafields = []
-        for k, v in self.properties.items():
+        for k, v in self.property_items:
             value = self.get(v)
             if value is not None:
                 value = str(value)
@@ -710,6 +862,8 @@ class EsBookConverter(EsProductConverter):
 
 
 class EsCdConverter(EsBookConverter):
+    __slots__ = ()
+
     properties = {
         'Artist': 'Artist',
         'Format': 'binding',
@@ -718,6 +872,7 @@ class EsCdConverter(EsBookConverter):
         'Publication Date': 'PublicationDate',
     }
 
+    @memoized
     def get_title(self):
         title = self.get('title')
         if title is None:
@@ -734,6 +889,7 @@ class EsCdConverter(EsBookConverter):
     def get_artist(self):
         return self.get('Artist')
 
+    @memoized
     def get_original_description(self):
         description = self.get('description')
 
@@ -763,6 +919,20 @@ class EsCdConverter(EsBookConverter):
         return properties
 
 
+def round_cents(values):
+    """np.round(values, 2), made to agree with round(value, 2) of parse_price.
+
+    np.round scales by 100 and rounds the product, which can tip values lying next to a half
+    cent the other way than the correctly rounded builtin. Those few are rounded one by one.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rounded = np.array(np.round(values, 2), dtype=np.float64)
+    fraction = np.abs(np.modf(values * 100)[0])
+    for i in np.flatnonzero(np.abs(fraction - 0.5) < 1e-6):
+        rounded.flat[i] = round(float(values.flat[i]), 2)
+    return rounded
+
+
 class AmazonProductPriceConverter(object):
     max_price = 500
 
@@ -825,8 +995,35 @@ class AmazonProductPriceConverter(object):
 
         return 0
 
+    @classmethod
+    def price_batch(cls, source_prices, min_roi=0.75, ad_cost=3.5, tax_rate=0.09, sales_rate=1.25, seed=None):
+        """Prices of many source prices at once, same formula as parse_price.
+
+        Every argument but seed may be a scalar or an array broadcastable to source_prices.
+        Returns a PriceBatch of price and compare-at price arrays plus a mask of the
+        products priced 0 (no source price, or above max_price).
+        """
+        source_prices = np.asarray(source_prices, dtype=np.float64)
+        min_roi = np.asarray(min_roi if min_roi is not None else 0.75, dtype=np.float64)
+        ad_cost = np.asarray(ad_cost if ad_cost is not None else 3.0, dtype=np.float64)
+        tax_rate = np.asarray(tax_rate, dtype=np.float64)
+
+        zero_price = (source_prices <= 0) | (source_prices > cls.max_price) | np.isnan(source_prices)
+        prices = (ad_cost + source_prices * (1 + tax_rate)) * (1 + min_roi) / 0.97
+        prices = round_cents(np.maximum(source_prices + 5, prices))
+        prices = np.where(zero_price, 0.0, prices)
+        zero_price = np.broadcast_to(zero_price, prices.shape)
+
+        sales_rate = np.broadcast_to(np.asarray(sales_rate, dtype=np.float64), prices.shape)
+        rng = np.random.default_rng(seed)
+        markup = rng.uniform(1.01, np.where(sales_rate > 0, sales_rate, 1.01))
+        compare_at_prices = np.where(sales_rate > 0, prices * markup, 0.0)
+
+        return PriceBatch(prices, compare_at_prices, zero_price)
+
 
 class EuropaProductConverter(EsProductConverter):
+    __slots__ = ()
 
     def get_source_price(self):
         return float(self.get('wholesaleprice'))
@@ -865,6 +1062,7 @@ class EuropaProductConverter(EsProductConverter):
     def get_sku(self):
         return self.get_asin()
 
+    @memoized
     def get_title(self):
         brand = self.get_brand()
         title = str(self.get('productname'))
@@ -881,15 +1079,18 @@ class EuropaProductConverter(EsProductConverter):
     def get_handle(self):
         return create_slug(self.get_title())
 
+    @memoized
     def get_brand(self):
         return str(self.get('vendorname'))
 
+    @memoized
     def get_image(self):
         try:
             return self.get_images()[0]
         except:
             pass
 
+    @memoized
     def get_upc(self):
         return self.get('upc')
 
@@ -909,6 +1110,7 @@ class EuropaProductConverter(EsProductConverter):
 
         return taxons
 
+    @memoized
     def get_description(self):
         desc = '<div class="container"><div class="row">'
         desc += '<div class="col-lg-7">'
@@ -963,12 +1165,15 @@ class EuropaProductConverter(EsProductConverter):
 
         return nutrition_facts
 
+    @memoized
     def get_original_description(self):
         return self.get_features()
 
+    @memoized
     def get_features(self):
         return '%s\n%s' % (self.get('productdesc'), self.get('productdetails'))
 
+    @memoized
     def get_images(self):
         image = self.get('picfile')
         if image is not None:
@@ -1012,19 +1217,22 @@ class EuropaProductConverter(EsProductConverter):
 
     def get(self, attr):
         attr = attr.lower()
-        if attr in self.product:
-            return self.product[attr]
+        product = self._product
+        if attr in product:
+            return product[attr]
         return None
 
 
 class AliExpressProductConverter(EsProductConverter):
+    __slots__ = ()
+
     def __init__(self, product, source_price=None, roi=0.75, ad_cost=3.0):
         super().__init__(product, source_price, roi, ad_cost)
         features_list = self.get_features_list()
         for key, value in features_list.items():
             if key not in product:
                 product[key] = value
-        self.product = product
+        self.invalidate()
 
     def get_source_price(self):
         return float(self.get('total_cost'))
@@ -1058,12 +1266,14 @@ class AliExpressProductConverter(EsProductConverter):
     def get_sku(self):
         return self.get_asin()
 
+    @memoized
     def get_title(self):
         return str(self.get('title'))
 
     def get_handle(self):
         return create_slug(self.get_title())
 
+    @memoized
     def get_brand(self):
         brand = self.get('Brand Name')
         if brand is not None:
@@ -1074,16 +1284,19 @@ class AliExpressProductConverter(EsProductConverter):
             return brand
         return self.get('brand')
 
+    @memoized
     def get_image(self):
         try:
             return self.get_images()[0]
         except:
             pass
 
+    @memoized
     def get_upc(self):
         product_id = self.get('upc')
         return product_id
 
+    @memoized
     def get_mpn(self):
         return self.get('productId')
 
@@ -1095,6 +1308,7 @@ class AliExpressProductConverter(EsProductConverter):
 
         return taxons
 
+    @memoized
     def get_description(self):
         feature = '<br>'.join(['<strong>%s: </strong> %s' % (k, v) for k, v in self.get_features_list().items()])
         desc = self.get_original_description()
@@ -1103,6 +1317,7 @@ class AliExpressProductConverter(EsProductConverter):
 
         return feature
 
+    @memoized
     def get_original_description(self):
         desc = self.get('description')
         if desc is None:
@@ -1131,6 +1346,7 @@ class AliExpressProductConverter(EsProductConverter):
 
         return feature_list
 
+    @memoized
     def get_features(self):
         return ''
         # desc = self.get_original_description()
@@ -1148,6 +1364,7 @@ class AliExpressProductConverter(EsProductConverter):
         #
         # return feature_list
 
+    @memoized
     def get_images(self):
         images = self.get('images')
         if images is not None:
@@ -1190,6 +1407,17 @@ class AliExpressProductConverter(EsProductConverter):
         return 0
 
     def get(self, attr):
-        if attr in self.product:
-            return self.product[attr]
+        product = self._product
+        if attr in product:
+            return product[attr]
         return None
+
+
+converter_registry = ConverterRegistry(default=EsProductConverter)
+converter_registry.register(EuropaProductConverter, prefix='ES', priority=100)
+converter_registry.register(AliExpressProductConverter, prefix='AE', priority=100)
+converter_registry.register(EsCdConverter, lambda p: p.get('binding') == 'Audio CD', priority=50)
+converter_registry.register(EsCdConverter, lambda p: p.get('ProductGroup') == 'Music', priority=50)
+converter_registry.register(EsCdConverter, lambda p: p.get('binding') == 'DVD', priority=50)
+converter_registry.register(EsDvdConverter, lambda p: p.get('ProductGroup') == 'DVD', priority=50)
+converter_registry.register(EsBookConverter, lambda p: not p['asin'].startswith('B'), priority=10)
@@ -0,0 +1,275 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# gmc expires products about 30 days after their last insert, unchanged ones are pushed again before that
+DEFAULT_REFRESH_AGE = 20 * 24 * 3600
+
+
+def fingerprint(google_product):
+    """Stable content hash of a built google product dict."""
+    data = json.dumps(google_product, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class FingerprintStore(object):
+    """Local record of what was last pushed to gmc, keyed by google_merchant_id.
+
+    refresh_age is the number of seconds after which an unchanged offer counts as changed again.
+    """
+
+    def __init__(self, db_path, refresh_age=DEFAULT_REFRESH_AGE):
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+
+        self.db_path = db_path
+        self.refresh_age = refresh_age
+        # shared by the pipeline workers, every statement runs under self.lock
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute('CREATE TABLE IF NOT EXISTS fingerprints ('
+                                'offer_id TEXT PRIMARY KEY, '
+                                'fingerprint TEXT, '
+                                'pushed_at REAL, '
+                                'seen_at REAL)')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(fingerprints)')]
+        if 'missed_runs' not in columns:
+            self.connection.execute('ALTER TABLE fingerprints ADD COLUMN missed_runs INTEGER DEFAULT 0')
+        self.connection.commit()
+        self.run_started = time.time()
+
+    def begin_run(self, run_started=None):
+        """Starts tracking seen offers; a resumed run passes the start time of the run it continues."""
+        self.run_started = run_started if run_started is not None else time.time()
+
+    def changed(self, offer_id, product_fingerprint):
+        """Returns whether the offer differs from what was last pushed, or was pushed too long ago."""
+        with self.lock:
+            row = self.connection.execute('SELECT fingerprint, pushed_at FROM fingerprints WHERE offer_id = ?',
+                                          (offer_id,)).fetchone()
+        if row is None or row[0] != product_fingerprint:
+            return True
+        return row[1] is None or row[1] < time.time() - self.refresh_age
+
+    def seen(self, offer_id):
+        """Marks the offer as still present in spree, so it is not reported by vanished."""
+        with self.lock:
+            self.connection.execute('UPDATE fingerprints SET seen_at = ?, missed_runs = 0 WHERE offer_id = ?',
+                                    (time.time(), offer_id))
+
+    def mark_pushed(self, offer_id, product_fingerprint):
+        now = time.time()
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO fingerprints (offer_id, fingerprint, pushed_at, seen_at, missed_runs) '
+                                    'VALUES (?, ?, ?, ?, 0)', (offer_id, product_fingerprint, now, now))
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+
+    def vanished(self):
+        """Offers pushed before that were not seen since begin_run."""
+        with self.lock:
+            rows = self.connection.execute('SELECT offer_id FROM fingerprints WHERE seen_at < ?', (self.run_started,))
+            return [row[0] for row in rows]
+
+    def record_missing(self, offer_ids, runs=2):
+        """Counts one more complete run in which the offers were not listed.
+
+        Returns the offers missing from `runs` consecutive runs. A single miss may just be an
+        offer skipped by the offset pagination while the catalog changed during the run.
+        """
+        with self.lock:
+            self.connection.executemany('UPDATE fingerprints SET missed_runs = missed_runs + 1 WHERE offer_id = ?',
+                                        [(i,) for i in offer_ids])
+            rows = self.connection.execute('SELECT offer_id FROM fingerprints WHERE seen_at < ? AND missed_runs >= ?',
+                                           (self.run_started, runs))
+            return [row[0] for row in rows]
+
+    def remove(self, offer_ids):
+        with self.lock:
+            self.connection.executemany('DELETE FROM fingerprints WHERE offer_id = ?', [(i,) for i in offer_ids])
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class SyncCheckpoint(object):
+    """Durable progress of a paged sync: the last page whose products were all handled and
+    the offers still in flight, written atomically so a killed run can be resumed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.last_page = 0
+        self.run_started = time.time()
+        self.pending = dict()
+        self.completed = set()
+        self.pages_by_offer = dict()
+
+    def load(self):
+        """Restores the state of an interrupted run, returns False if there is none."""
+        if not os.path.isfile(self.path):
+            return False
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.last_page = data['last_page']
+        self.run_started = data['run_started']
+        return True
+
+    def start_page(self, page, offer_ids):
+        with self.lock:
+            self.pending[page] = set(offer_ids)
+            for offer_id in offer_ids:
+                self.pages_by_offer.setdefault(offer_id, []).append(page)
+            if len(offer_ids) == 0:
+                return self._complete(page)
+        return False
+
+    def done(self, offer_id):
+        """Marks one offer as handled, returns True when that moved last_page forward."""
+        with self.lock:
+            pages = self.pages_by_offer.get(offer_id)
+            if not pages:
+                return False
+            page = pages.pop(0)
+            if len(pages) == 0:
+                del self.pages_by_offer[offer_id]
+
+            in_flight = self.pending.get(page)
+            if in_flight is None:
+                return False
+            in_flight.discard(offer_id)
+            if len(in_flight) > 0:
+                return False
+            return self._complete(page)
+
+    def _complete(self, page):
+        del self.pending[page]
+        self.completed.add(page)
+        advanced = False
+        while self.last_page + 1 in self.completed:
+            self.last_page += 1
+            self.completed.discard(self.last_page)
+            advanced = True
+        return advanced
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                data = {
+                    'last_page': self.last_page,
+                    'run_started': self.run_started,
+                    'saved_at': time.time(),
+                    'in_flight': sorted(offer_id for offers in self.pending.values() for offer_id in offers),
+                }
+
+            checkpoint_dir = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(checkpoint_dir):
+                os.makedirs(checkpoint_dir)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+StatusChange = namedtuple('StatusChange', ['product_id', 'kind', 'previous', 'current'])
+StatusSnapshot = namedtuple('StatusSnapshot', ['status', 'issue_codes', 'expiration'])
+
+
+def status_snapshot(stat):
+    """Compact view of a productstatuses resource: destination statuses, item issue codes and expiration."""
+    status = ','.join(sorted('%s:%s' % (s['destination'], s['status']) for s in stat.get('destinationStatuses', [])))
+    issue_codes = ','.join(sorted(set(issue['code'] for issue in stat.get('itemLevelIssues', []))))
+    return StatusSnapshot(status, issue_codes, stat.get('googleExpirationDate'))
+
+
+class StatusSnapshotStore(object):
+    """Last seen gmc status of every product, keyed by productId, to act on transitions only."""
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute('CREATE TABLE IF NOT EXISTS statuses ('
+                                'product_id TEXT PRIMARY KEY, '
+                                'status TEXT, '
+                                'issue_codes TEXT, '
+                                'expiration TEXT, '
+                                'seen_at REAL)')
+        self.connection.commit()
+        self.run_started = time.time()
+
+    def begin_run(self):
+        self.run_started = time.time()
+
+    def get(self, product_id):
+        with self.lock:
+            row = self.connection.execute('SELECT status, issue_codes, expiration FROM statuses WHERE product_id = ?',
+                                          (product_id,)).fetchone()
+        return StatusSnapshot(*row) if row is not None else None
+
+    def record(self, stat):
+        """Stores the status and returns a StatusChange, or None if it is the same as in the last snapshot."""
+        product_id = stat['productId']
+        current = status_snapshot(stat)
+        previous = self.get(product_id)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO statuses (product_id, status, issue_codes, expiration, seen_at) '
+                                    'VALUES (?, ?, ?, ?, ?)', (product_id,) + tuple(current) + (time.time(),))
+        if previous is None:
+            return StatusChange(product_id, 'added', None, current)
+        if previous != current:
+            return StatusChange(product_id, 'changed', previous, current)
+        return None
+
+    def diff(self, stats):
+        """Records every status and yields the changes, see record."""
+        for stat in stats:
+            change = self.record(stat)
+            if change is not None:
+                yield change
+
+    def removed(self):
+        """Products in the last snapshot that were not recorded since begin_run."""
+        with self.lock:
+            rows = self.connection.execute('SELECT product_id, status, issue_codes, expiration FROM statuses WHERE seen_at < ?',
+                                           (self.run_started,)).fetchall()
+        return [StatusChange(row[0], 'removed', StatusSnapshot(*row[1:]), None) for row in rows]
+
+    def forget(self, product_ids):
+        with self.lock:
+            self.connection.executemany('DELETE FROM statuses WHERE product_id = ?', [(i,) for i in product_ids])
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
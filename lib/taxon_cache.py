@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+import time
+
+from lib import logger
+
+SEPARATOR = '>'
+
+
+class TaxonCache(object):
+    """All taxons of a taxonomy, indexed by their path below the taxonomy root ('Home>Kitchen').
+
+    Loaded in bulk once from SpreeApi.taxon_index and kept on disk together with the ETag of the spree response it
+    came from. The snapshot is reused while spree reports the same ETag (or, without ETag,
+    for max_age seconds) and is updated in place as taxons get created.
+    """
+
+    def __init__(self, spree_api, taxonomy_id, cache_path=None, per_page=1000, max_age=24 * 3600):
+        self.spree_api = spree_api
+        self.taxonomy_id = taxonomy_id
+        self.cache_path = cache_path if cache_path is not None else 'data/taxons_%s.json' % taxonomy_id
+        self.per_page = per_page
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.etag = None
+        self.version = 0
+        self.loaded_at = 0
+        self.ids = dict()
+        self.paths = dict()
+        self.parents = dict()
+        self.dirty = False
+
+    def load(self):
+        etag = self.spree_api.taxons_etag(self.taxonomy_id, self.per_page)
+        if self.load_snapshot(etag):
+            logger.info("%s taxons of taxonomy %s loaded from %s", len(self.ids), self.taxonomy_id, self.cache_path)
+            return self
+
+        index = self.spree_api.taxon_index(self.taxonomy_id, self.per_page)
+        with self.lock:
+            self.ids = index['ids']
+            self.paths = index['paths']
+            self.parents = index['parents']
+            self.etag = etag
+            self.version += 1
+            self.loaded_at = time.time()
+        self.save()
+        logger.info("%s taxons of taxonomy %s loaded from spree", len(self.ids), self.taxonomy_id)
+        return self
+
+    def load_snapshot(self, etag):
+        if not os.path.isfile(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except ValueError:
+            return False
+
+        if data.get('taxonomy_id') != self.taxonomy_id:
+            return False
+        if etag is not None and data.get('etag') != etag:
+            return False
+        if etag is None and time.time() - data.get('loaded_at', 0) > self.max_age:
+            return False
+
+        with self.lock:
+            self.ids = data['ids']
+            self.paths = dict((int(taxon_id), path) for taxon_id, path in data['paths'].items())
+            self.parents = dict((int(taxon_id), parent_id) for taxon_id, parent_id in data.get('parents', {}).items())
+            self.etag = data.get('etag')
+            self.version = data.get('version', 0)
+            self.loaded_at = data.get('loaded_at', 0)
+        return True
+
+    def get(self, path):
+        return self.ids.get(path)
+
+    def path_of(self, taxon_id):
+        return self.paths.get(taxon_id)
+
+    def parent_of(self, taxon_id):
+        return self.parents.get(taxon_id)
+
+    def add(self, path, taxon_id, parent_id=None):
+        """Records a taxon created since the load, persisted by the next flush."""
+        with self.lock:
+            self.ids[path] = taxon_id
+            self.paths[taxon_id] = path
+            self.parents[taxon_id] = parent_id
+            self.version += 1
+            self.dirty = True
+
+    def flush(self):
+        """Saves the snapshot if taxons were added since it was last written."""
+        if self.dirty:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            data = {
+                'taxonomy_id': self.taxonomy_id,
+                'etag': self.etag,
+                'version': self.version,
+                'loaded_at': self.loaded_at,
+                'ids': self.ids,
+                'paths': self.paths,
+                'parents': self.parents,
+            }
+            cache_dir = os.path.dirname(os.path.abspath(self.cache_path))
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.cache_path)
+            self.dirty = False
+
+
+class CategoryRules(object):
+    """Turns a raw category ('Books>Subjects>CDs & Vinyl>Jazz' or a list of segments) into the
+    segments of its taxon path, with the ignore and replacement rules applied.
+
+    Normalized paths are memoized, feeds repeat the same few categories on every product.
+    """
+
+    def __init__(self, root_category='Categories', ignore=None, replacements=None, first_level_category=None):
+        self.root_category = root_category
+        self.ignore = frozenset(ignore if ignore is not None else ['Books', 'Subjects'])
+        self.replacements = dict(replacements if replacements is not None else {'CDs & Vinyl': 'Music'})
+        self.first_level_category = first_level_category
+        self.normalized = dict()
+
+    def normalize(self, category):
+        """Returns the path as a tuple of taxon names, None when the category is skipped."""
+        raw = category if isinstance(category, str) else tuple(category)
+        if raw in self.normalized:
+            return self.normalized[raw]
+
+        segments = category.split(SEPARATOR) if isinstance(category, str) else category
+        segments = [s.strip() for s in segments if s not in self.ignore]
+        path = None
+        if self.first_level_category is None or self.first_level_category in segments:
+            path = []
+            for segment in segments:
+                if segment in self.ignore or segment == self.first_level_category:
+                    continue
+                segment = self.replacements.get(segment, segment)
+                if not path and segment == self.root_category:
+                    continue
+                path.append(segment)
+            path = tuple(path)
+
+        self.normalized[raw] = path
+        return path
+
+
+class TaxonNode(object):
+    __slots__ = ('taxon_id', 'children')
+
+    def __init__(self, taxon_id=None):
+        self.taxon_id = taxon_id
+        self.children = dict()
+
+
+class TaxonTrie(object):
+    """Taxons below a root taxon, one node per taxon with its children by name.
+
+    Resolving a path walks the trie once and returns the ids of every taxon on it. Missing
+    taxons are looked up in spree and created when they don't exist; both results are kept in
+    the trie and in the TaxonCache backing it, which is saved once per resolve_batch.
+    """
+
+    def __init__(self, spree_api, taxonomy_id, root_id, taxon_cache=None):
+        self.spree_api = spree_api
+        self.taxonomy_id = taxonomy_id
+        self.root = TaxonNode(root_id)
+        self.taxon_cache = taxon_cache
+        self.root_path = None
+        self.lock = threading.RLock()
+        if taxon_cache is not None:
+            self.root_path = taxon_cache.path_of(root_id)
+            self.load(taxon_cache)
+
+    def load(self, taxon_cache):
+        prefix = self.root_path + SEPARATOR if self.root_path else ''
+        for path, taxon_id in taxon_cache.ids.items():
+            if not path.startswith(prefix):
+                continue
+            node = self.root
+            for name in path[len(prefix):].split(SEPARATOR):
+                node = node.children.setdefault(name, TaxonNode())
+            node.taxon_id = taxon_id
+
+    def resolve(self, path, failed=None):
+        """Returns the taxon ids from the root down to the end of path.
+
+        The walk stops at a taxon that could not be created, names in failed are not retried.
+        """
+        taxon_ids = [self.root.taxon_id]
+        with self.lock:
+            node = self.root
+            for depth, name in enumerate(path):
+                child = node.children.get(name)
+                if child is None or child.taxon_id is None:
+                    if failed is not None and path[:depth + 1] in failed:
+                        break
+                    child = self.add_child(node, name, path[:depth + 1])
+                    if child is None:
+                        if failed is not None:
+                            failed.add(path[:depth + 1])
+                        break
+                taxon_ids.append(child.taxon_id)
+                node = child
+        return taxon_ids
+
+    def resolve_batch(self, paths):
+        """Resolves many paths at once, every missing taxon is created a single time.
+
+        Returns a dict of path -> taxon ids.
+        """
+        failed = set()
+        resolved = dict()
+        # shorter paths first, so parents exist before their children are walked
+        try:
+            for path in sorted(set(p for p in paths if p is not None), key=len):
+                resolved[path] = self.resolve(path, failed)
+        finally:
+            # the snapshot is written once per batch, not per created taxon
+            if self.taxon_cache is not None:
+                self.taxon_cache.flush()
+        return resolved
+
+    def add_child(self, node, name, path):
+        # spree is asked even with a cache, the snapshot may predate taxons created elsewhere
+        taxon = self.spree_api.find_taxon_by_name(name, node.taxon_id, self.taxonomy_id)
+        taxon_id = taxon['id'] if taxon is not None else None
+        if taxon_id is not None and self.taxon_cache is not None:
+            if taxon.get('parent_id') != node.taxon_id:
+                # a namesake under another parent, not the taxon we are after
+                taxon_id = None
+            else:
+                self.taxon_cache.add(self.cache_path(path), taxon_id, node.taxon_id)
+
+        if taxon_id is None:
+            try:
+                response = self.spree_api.create_taxon(self.taxonomy_id, name, node.taxon_id).json()
+                taxon_id = response['id']
+                logger.info("%s-%s", name, node.taxon_id)
+            except Exception as e:
+                logger.error("taxon %s under %s not created - %s", name, node.taxon_id, e)
+                return None
+            if self.taxon_cache is not None:
+                self.taxon_cache.add(self.cache_path(path), taxon_id, node.taxon_id)
+
+        child = node.children.setdefault(name, TaxonNode())
+        child.taxon_id = taxon_id
+        return child
+
+    def cache_path(self, path):
+        path = SEPARATOR.join(path)
+        return self.root_path + SEPARATOR + path if self.root_path else path
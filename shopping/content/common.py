@@ -17,40 +17,202 @@
 
 from __future__ import print_function
 
+import datetime
+import json
 import os
 import random
 import sys
+import threading
 import time
 import httplib2
 from googleapiclient import errors
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
 from oauth2client.service_account import ServiceAccountCredentials
 
 from shopping.content import _constants
+from shopping.content import transport
 
 rootDir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+cacheDir = os.path.join(rootDir, 'data', 'cache')
+
+DISCOVERY_URI = ('https://www.googleapis.com/discovery/v1/apis/%s/%s/rest' %
+                 (_constants.SERVICE_NAME, _constants.SERVICE_VERSION))
+# The discovery document only changes with API releases, account details
+# hardly ever.
+DISCOVERY_CACHE_TTL = 24 * 3600
+ACCOUNT_CACHE_TTL = 24 * 3600
+# Access tokens are refreshed this long before they expire.
+TOKEN_REFRESH_MARGIN = 300
+
+_account_configs = {}
+_discovery_documents = {}
+_merchant_services = {}
+_merchant_services_lock = threading.Lock()
 
 
 # Authenticate and return the Content API service along with any command-line
-# flags/arguments.
-def init(merchant_id):
+# flags/arguments. With a rate_limiter (rate_limit.AdaptiveRateLimiter) every
+# request of the service is throttled through it.
+#
+# Services are cached per merchant and are safe to share between threads: each
+# thread executes requests over its own httplib2.Http.
+def init(merchant_id, rate_limiter=None):
     flags = None
-    content_path = os.path.join(rootDir, 'data')
-    service_account_path = os.path.join(content_path, merchant_id + '.json')
+    merchant_services = get_merchant_services(merchant_id, rate_limiter)
+    service = merchant_services.service()
+    return service, dict(merchant_services.config), flags
+
+
+def get_merchant_services(merchant_id, rate_limiter=None):
+    """Returns the process-wide MerchantServices of a merchant.
+
+    The rate_limiter of the first call for a merchant is the one used.
+    """
+    merchant_id = str(merchant_id)
+    with _merchant_services_lock:
+        merchant_services = _merchant_services.get(merchant_id)
+        if merchant_services is None:
+            merchant_services = MerchantServices(merchant_id, rate_limiter)
+            _merchant_services[merchant_id] = merchant_services
+    return merchant_services
+
+
+class MerchantServices(object):
+    """Credentials and thread-safe service object of one merchant.
+
+    The access token is refreshed by a timer shortly before it expires, so
+    requests don't hit expired tokens and refresh on failure.
+    """
+
+    def __init__(self, merchant_id, rate_limiter=None):
+        content_path = os.path.join(rootDir, 'data')
+        service_account_path = os.path.join(content_path, merchant_id + '.json')
+
+        self.merchant_id = merchant_id
+        self.rate_limiter = rate_limiter
+        self.credentials = ServiceAccountCredentials.from_json_keyfile_name(
+            filename=service_account_path,
+            scopes=_constants.CONTENT_API_SCOPE)
+        self.lock = threading.Lock()
+        self.thread_http = transport.ThreadLocalHttp(self.http)
+        self.refresh_token()
+        self._service = build_service(self.http(), requestBuilder=transport.request_builder(
+            thread_http=self.thread_http, rate_limiter=rate_limiter))
+
+        self.config = {"merchantId": int(merchant_id), "accountSampleUser": "", "accountSampleAdWordsCID": 0,
+                       'path': content_path, 'service_account_path': service_account_path}
+        retrieve_cached_config(self.service(), self.config)
+
+    def http(self):
+        """Returns a new authorized httplib2.Http sharing the merchant's token."""
+        return self.credentials.authorize(httplib2.Http())
+
+    def service(self):
+        """Returns the merchant's service, shared by all threads."""
+        return self._service
+
+    def refresh_token(self):
+        try:
+            with self.lock:
+                self.credentials.refresh(httplib2.Http())
+            expiry = self.credentials.token_expiry
+            delay = TOKEN_REFRESH_MARGIN
+            if expiry is not None:
+                delay = (expiry - datetime.datetime.utcnow()).total_seconds() - TOKEN_REFRESH_MARGIN
+        except Exception as e:
+            print('Could not refresh the access token of %s: %s' % (self.merchant_id, e))
+            delay = 30
+        timer = threading.Timer(max(30, delay), self.refresh_token)
+        timer.daemon = True
+        timer.start()
+
+
+def build_service(http, **kwargs):
+    """Builds the Content API service from a cached discovery document.
+
+    The document is downloaded again once it is older than
+    DISCOVERY_CACHE_TTL. If that fails, build() fetches it as usual.
+
+    Args:
+      http: authorized httplib2.Http the service uses.
+      **kwargs: passed on to build_from_document (e.g. requestBuilder).
+    """
+    cache_name = 'discovery_%s_%s.json' % (_constants.SERVICE_NAME,
+                                           _constants.SERVICE_VERSION)
+    document = _discovery_documents.get(cache_name)
+    if document is None:
+        document = read_cache(cache_name, DISCOVERY_CACHE_TTL)
+    if document is None:
+        try:
+            response, content = httplib2.Http(timeout=30).request(DISCOVERY_URI)
+            if response.status == 200:
+                document = json.loads(content.decode('utf-8'))
+                write_cache(cache_name, document)
+        except (httplib2.HttpLib2Error, IOError, ValueError) as e:
+            print('Could not download the discovery document: %s' % e)
+    if document is None:
+        return build(_constants.SERVICE_NAME, _constants.SERVICE_VERSION,
+                     http=http, **kwargs)
+    _discovery_documents[cache_name] = document
+    return build_from_document(document, http=http, **kwargs)
 
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        filename=service_account_path,
-        scopes=_constants.CONTENT_API_SCOPE)
 
-    http = credentials.authorize(httplib2.Http())
+def retrieve_cached_config(service, config):
+    """Fills config like retrieve_remaining_config_from_api, memoized per merchant.
 
-    service = build(_constants.SERVICE_NAME, _constants.SERVICE_VERSION, http=http)
+    Results are kept for the process and on disk for ACCOUNT_CACHE_TTL, so
+    short jobs skip the authinfo and account lookups.
 
-    config = {"merchantId": int(merchant_id), "accountSampleUser": "", "accountSampleAdWordsCID": 0, 'path': content_path,
-              'service_account_path': service_account_path}
+    Args:
+      service: Content API service object
+      config: dictionary, Python representation of config JSON.
+    """
+    merchant_id = config['merchantId']
+    cache_name = 'account_%s.json' % merchant_id
+    cached = _account_configs.get(merchant_id)
+    if cached is None:
+        cached = read_cache(cache_name, ACCOUNT_CACHE_TTL)
+    if cached is None:
+        retrieve_remaining_config_from_api(service, config)
+        cached = {'isMCA': config['isMCA'], 'websiteUrl': config['websiteUrl']}
+        write_cache(cache_name, cached)
+    _account_configs[merchant_id] = cached
+    config.update(cached)
+
+
+def read_cache(name, ttl):
+    """Returns the cached JSON value, or None if missing or older than ttl seconds."""
+    path = os.path.join(cacheDir, name)
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_cache(name, value):
+    """Atomically writes a JSON value to the cache directory."""
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    path = os.path.join(cacheDir, name)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def authorized_http(config):
+    """Returns a new authorized httplib2.Http for the configured service account.
+
+    httplib2.Http objects are not thread-safe, so every thread that executes
+    requests needs its own, passed as execute(http=...).
 
-    retrieve_remaining_config_from_api(service, config)
-    return service, config, flags
+    Args:
+      config: dictionary, as returned by init.
+    """
+    return get_merchant_services(config['merchantId']).http()
 
 
 unique_id_increment = 0
@@ -0,0 +1,121 @@
+"""Client-side throttling of Content API requests.
+
+Every request of a service from common.init(..., rate_limiter=...) waits
+for a token from the bucket of its API method and for a free concurrency slot
+before it is sent. Throttling (429) and server (5xx) errors halve both the rate
+and the concurrency limit, successes grow them back additively (AIMD).
+"""
+
+import threading
+import time
+
+# Requests per second each method starts at and never exceeds.
+DEFAULT_BUDGETS = {
+    'content.products.insert': 20.0,
+    'content.products.delete': 20.0,
+    'content.products.custombatch': 2.0,
+    'content.productstatuses.list': 5.0,
+}
+DEFAULT_RATE = 10.0
+BACKOFF_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket refilled at `rate` tokens per second."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveRateLimiter(object):
+    """Per-method token buckets plus an AIMD controlled concurrency limit.
+
+    Args:
+      budgets: dict, requests per second allowed for each API method id.
+      default_rate: float, budget of methods missing from budgets.
+      max_concurrency: int, upper bound of requests in flight.
+      min_rate: float, the rate never drops below this.
+      increase: float, requests per second added to a method's rate per success.
+      decrease: float, factor applied to rate and concurrency on 429/5xx.
+    """
+
+    def __init__(self, budgets=None, default_rate=DEFAULT_RATE, max_concurrency=16,
+                 min_rate=0.5, increase=0.1, decrease=0.5):
+        self.budgets = dict(DEFAULT_BUDGETS)
+        if budgets:
+            self.budgets.update(budgets)
+        self.default_rate = default_rate
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+
+        self.buckets = {}
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self.condition = threading.Condition()
+
+    def bucket(self, method_id):
+        with self.condition:
+            bucket = self.buckets.get(method_id)
+            if bucket is None:
+                bucket = TokenBucket(self.budgets.get(method_id, self.default_rate))
+                self.buckets[method_id] = bucket
+            return bucket
+
+    def acquire(self, method_id):
+        self.bucket(method_id).acquire()
+        with self.condition:
+            while self.in_flight >= int(self.concurrency):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, method_id, status):
+        """Frees the concurrency slot and adapts the limits to the response status."""
+        bucket = self.bucket(method_id)
+        budget = self.budgets.get(method_id, self.default_rate)
+        with self.condition:
+            self.in_flight -= 1
+            if status is None:
+                # transport failure, no signal about the quota
+                pass
+            elif status in BACKOFF_STATUSES:
+                self.throttled += 1
+                bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+                self.concurrency = max(1.0, self.concurrency * self.decrease)
+            else:
+                bucket.rate = min(budget, bucket.rate + self.increase)
+                # one more slot per window of successful requests
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 1.0 / self.concurrency)
+            self.condition.notify_all()
+
+    def rate(self, method_id):
+        """Current requests per second allowed for the method."""
+        return self.bucket(method_id).rate
+
+    def stats(self):
+        with self.condition:
+            return {
+                'concurrency': int(self.concurrency),
+                'in_flight': self.in_flight,
+                'throttled': self.throttled,
+                'rates': dict((method_id, round(bucket.rate, 2)) for method_id, bucket in self.buckets.items()),
+            }
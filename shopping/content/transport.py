@@ -0,0 +1,71 @@
+"""Thread-safe request execution for Content API service objects.
+
+httplib2.Http is not thread-safe, so a service built with the request builder
+below executes every request over an authorized Http owned by the calling
+thread. One service object can then be shared by a whole worker pool.
+"""
+
+import threading
+
+from googleapiclient import errors
+from googleapiclient.http import HttpRequest
+
+
+class ThreadLocalHttp(object):
+    """Hands each thread its own http, created on first use by http_factory."""
+
+    def __init__(self, http_factory):
+        self.http_factory = http_factory
+        self.local = threading.local()
+
+    def get(self):
+        http = getattr(self.local, 'http', None)
+        if http is None:
+            http = self.http_factory()
+            self.local.http = http
+        return http
+
+
+class ServiceHttpRequest(HttpRequest):
+    """HttpRequest executed over the calling thread's http, optionally rate limited.
+
+    An http passed to execute explicitly is used as is.
+    """
+
+    thread_http = None
+    rate_limiter = None
+
+    def execute(self, http=None, num_retries=0):
+        if http is None and self.thread_http is not None:
+            http = self.thread_http.get()
+        if self.rate_limiter is None:
+            return super(ServiceHttpRequest, self).execute(http=http, num_retries=num_retries)
+
+        self.rate_limiter.acquire(self.methodId)
+        status = None
+        try:
+            result = super(ServiceHttpRequest, self).execute(http=http, num_retries=num_retries)
+            status = 200
+            return result
+        except errors.HttpError as e:
+            status = e.resp.status
+            raise
+        finally:
+            self.rate_limiter.release(self.methodId, status)
+
+
+def request_builder(thread_http=None, rate_limiter=None):
+    """Returns a requestBuilder for googleapiclient.discovery.build.
+
+    Args:
+      thread_http: ThreadLocalHttp requests are executed over.
+      rate_limiter: rate_limit.AdaptiveRateLimiter throttling the requests.
+    """
+
+    def build_request(*args, **kwargs):
+        request = ServiceHttpRequest(*args, **kwargs)
+        request.thread_http = thread_http
+        request.rate_limiter = rate_limiter
+        return request
+
+    return build_request
@@ -0,0 +1,25 @@
+from lib.product_converters import EsProductConverter
+
+if __name__ == '__main__':
+    product = {'asin': 'B000TEST', 'title': 'original', 'attributes': {'Color': {'value': 'red'}}}
+    converter = EsProductConverter(product)
+    assert converter.get_title() == 'original'
+    assert converter.get('Color') == 'red'
+
+    converter.product['title'] = 'changed'
+    assert converter.get_title() == 'changed', converter.get_title()
+    assert product['title'] == 'changed'
+
+    converter.product['attributes'] = {'Color': {'value': 'blue'}}
+    assert converter.get('Color') == 'blue', converter.get('Color')
+
+    del converter.product['title']
+    assert converter.get_title() != 'changed'
+
+    converter.product.update(title='updated')
+    assert converter.get_title() == 'updated', converter.get_title()
+
+    converter.product = {'asin': 'B000OTHER', 'title': 'other'}
+    assert converter.get_title() == 'other'
+    assert converter.get('Color') is None
+    print('ok')
@@ -0,0 +1,19 @@
+import numpy as np
+
+from lib.product_converters import AmazonProductPriceConverter
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    source_prices = rng.integers(-100, 60000, 200000) / 100
+    rois = rng.uniform(0.1, 1.0, source_prices.size).round(2)
+
+    batch = AmazonProductPriceConverter.price_batch(source_prices, rois, 3.0)
+    expected = np.array([AmazonProductPriceConverter('', source_price, roi, 3.0).price
+                         for source_price, roi in zip(source_prices.tolist(), rois.tolist())])
+
+    mismatches = np.flatnonzero(batch.prices != expected)
+    for i in mismatches[:10]:
+        print(source_prices[i], rois[i], expected[i], batch.prices[i])
+    assert len(mismatches) == 0, '%s prices differ' % len(mismatches)
+    assert np.array_equal(batch.zero_price, expected == 0)
+    print('%s prices match' % len(expected))
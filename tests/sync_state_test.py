@@ -0,0 +1,46 @@
+import os
+import tempfile
+import time
+
+from lib.sync_state import FingerprintStore
+
+if __name__ == '__main__':
+    db_path = os.path.join(tempfile.mkdtemp(), 'fingerprints.db')
+    store = FingerprintStore(db_path, refresh_age=20 * 24 * 3600)
+
+    store.mark_pushed('1', 'abc')
+    assert not store.changed('1', 'abc'), 'a fresh identical fingerprint is skipped'
+    assert store.changed('1', 'def'), 'a different fingerprint is pushed'
+    assert store.changed('2', 'abc'), 'an unknown offer is pushed'
+
+    stale = time.time() - 21 * 24 * 3600
+    store.connection.execute('UPDATE fingerprints SET pushed_at = ? WHERE offer_id = ?', (stale, '1'))
+    assert store.changed('1', 'abc'), 'a stale identical fingerprint is pushed again before gmc expires it'
+
+    store.mark_pushed('1', 'abc')
+    assert not store.changed('1', 'abc'), 'pushing it again resets the refresh age'
+
+    # offers 1 and 2 are pushed, then one complete run doesn't list 2
+    store.mark_pushed('2', 'abc')
+    time.sleep(0.01)
+    store.begin_run()
+    store.seen('1')
+    assert store.vanished() == ['2']
+    assert store.record_missing(store.vanished(), runs=2) == [], 'one missed run is not enough to delete'
+
+    # listed again in the next run, the miss is forgotten
+    time.sleep(0.01)
+    store.begin_run()
+    store.seen('1')
+    store.seen('2')
+    assert store.record_missing(store.vanished(), runs=2) == []
+    time.sleep(0.01)
+    store.begin_run()
+    assert store.record_missing(store.vanished(), runs=2) == []
+
+    # missing from two runs in a row, it is gone from spree
+    time.sleep(0.01)
+    store.begin_run()
+    assert sorted(store.record_missing(store.vanished(), runs=2)) == ['1', '2']
+    store.close()
+    print('ok')
@@ -1,18 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
 from lib import logger
 from lib.SpreeApiWrapper import SpreeApi
 from lib.SpreeImporter import SpreeProductImporter
 from lib.config_loaders import IniConfigLoader
 from lib.feed_file_iterator import FeedFileIterator
+from lib.taxon_cache import TaxonCache
 
+TAXONOMY_ID = 67
+ROOT_CATEGORY_ID = 304
 
-def run():
+
+@click.command('assign spree products to the categories of the feed')
+@click.option('-b', '--bulk', is_flag=True, help='resolve all categories first, then update products concurrently')
+@click.option('-w', '--workers', type=int, default=16, help='concurrent product updates in bulk mode')
+def run(bulk, workers):
     default_file_path = 'config.ini'
     config = IniConfigLoader(default_file_path)
 
     config.set_section('spree')
     api_token = config.get('api_token')
     endpoint = config.get('endpoint')
-    spree_api = SpreeApi(endpoint, api_token)
+    spree_api = SpreeApi(endpoint, api_token, pool_size=max(20, workers))
     file_iterator = FeedFileIterator('data/em2.csv')
     mapping = {}
     for lines in file_iterator.read_butch(100, ','):
@@ -21,31 +32,76 @@ def run():
         for line in lines:
             mapping[line['id']] = line['cat']
 
-    importer = SpreeProductImporter(spree_api, taxonomy_id=67,
-                                    root_category_id=304)
-
-    per_page = 100
-    page = 1
-    while True:
-        products = spree_api.list_products(page, per_page)
-        for product in products:
-            try:
-                google_merchant_id = product['google_merchant_id']
-                if google_merchant_id not in mapping:
-                    logger.error("%s cat not found", google_merchant_id)
-                    continue
-
-                cat = mapping[google_merchant_id]
-                categories = cat.split(' > ')
-                importer.update_taxons(product['slug'], [categories])
-
-                logger.info("%s %s", product['slug'], categories)
-            except Exception as e:
-                logger.exception(e)
-
-        if len(products) < per_page:
-            break
-        page += 1
+    taxon_cache = TaxonCache(spree_api, taxonomy_id=TAXONOMY_ID).load()
+    importer = SpreeProductImporter(spree_api, taxonomy_id=TAXONOMY_ID,
+                                    root_category_id=ROOT_CATEGORY_ID, taxon_cache=taxon_cache)
+
+    if bulk:
+        bulk_update(spree_api, importer, mapping, workers)
+        return
+
+    for product in spree_api.iter_all_products(per_page=100, concurrency=4, ordered=False):
+        try:
+            google_merchant_id = product['google_merchant_id']
+            if google_merchant_id not in mapping:
+                logger.error("%s cat not found", google_merchant_id)
+                continue
+
+            cat = mapping[google_merchant_id]
+            categories = cat.split(' > ')
+            importer.update_taxons(product['slug'], [categories])
+
+            logger.info("%s %s", product['slug'], categories)
+        except Exception as e:
+            logger.exception(e)
+
+
+def bulk_update(spree_api, importer, mapping, workers):
+    """Resolves the taxons of every product in one batch, then only updates products whose taxons differ."""
+    products = []
+    missing = 0
+    for product in spree_api.iter_all_products(per_page=100, concurrency=4, ordered=False):
+        google_merchant_id = product.get('google_merchant_id')
+        if google_merchant_id not in mapping:
+            logger.error("%s cat not found", google_merchant_id)
+            missing += 1
+            continue
+        products.append((product['slug'], mapping[google_merchant_id].split(' > '), product.get('taxon_ids')))
+
+    # every missing taxon is created here, once, before any product is touched
+    taxon_ids = importer.prepare_category_ids_batch(TAXONOMY_ID, [[categories] for _, categories, _ in products])
+
+    groups = dict()
+    skipped = 0
+    for (slug, categories, current_ids), ids in zip(products, taxon_ids):
+        ids = frozenset(ids)
+        if current_ids is not None and frozenset(current_ids) == ids:
+            skipped += 1
+            continue
+        groups.setdefault(ids, []).append(slug)
+    logger.info("%s products to update in %s taxon sets", sum(len(slugs) for slugs in groups.values()), len(groups))
+
+    def update(item):
+        slug, ids = item
+        try:
+            response = spree_api.update_product(slug, {'product': {'taxon_ids': ids}})
+            if response.ok:
+                return True
+            logger.error("%s - %s %s", slug, response.status_code, response.text[:200])
+        except Exception as e:
+            logger.exception(e)
+        return False
+
+    updates = ((slug, sorted(ids)) for ids, slugs in groups.items() for slug in slugs)
+    changed = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for ok in pool.map(update, updates):
+            if ok:
+                changed += 1
+            else:
+                failed += 1
+
+    logger.info("changed %s, skipped %s, missing %s, failed %s", changed, skipped, missing, failed)
 
 
 if __name__ == '__main__':